@@ -0,0 +1,177 @@
+import argparse
+import json
+import statistics
+import time
+import torch
+from torch import nn
+from torchvision import models
+
+#Backbone builders by name and the attribute holding their replaceable head
+registry = {}
+feature_sizes = {}
+
+
+def register(name, builder, head='classifier'):
+    registry[name] = {'builder': builder, 'head': head}
+
+
+register('vgg16', models.vgg16)
+register('densenet161', models.densenet161)
+register('resnet18', models.resnet18, 'fc')
+register('resnet50', models.resnet50, 'fc')
+register('mobilenet_v2', models.mobilenet_v2)
+register('mobilenet_v3_large', models.mobilenet_v3_large)
+register('efficientnet_b0', models.efficientnet_b0)
+
+
+def lookup(arch):
+    #Registered backbones first, then any other torchvision classification model by name
+    if arch in registry:
+        return registry[arch]
+    builder = getattr(models, arch, None)
+    if arch.startswith('_') or not callable(builder) or isinstance(builder, type):
+        return None
+    #Newer torchvision lists its models, which leaves out helpers such as get_model
+    if hasattr(models, 'list_models') and arch not in models.list_models(module=models):
+        return None
+    return {'builder': builder, 'head': None}
+
+
+def names():
+    return sorted(registry)
+
+
+def build(arch, pretrained=True):
+    entry = lookup(arch)
+    if entry is None:
+        return None
+    return entry['builder'](pretrained = pretrained)
+
+
+def headName(arch, model=None):
+    entry = lookup(arch)
+    if entry is not None and entry['head'] is not None:
+        return entry['head']
+    #Unregistered torchvision models name their head fc, classifier or heads
+    for name in ['fc', 'classifier', 'heads', 'head']:
+        if model is not None and hasattr(model, name):
+            return name
+    return 'classifier'
+
+
+class Probe(nn.Module):
+    #Stands in for the head during the dry run and records the shape of what it receives
+    def __init__(self):
+        super().__init__()
+        self.shapes = []
+
+    def forward(self, x):
+        self.shapes.append(tuple(x.shape))
+        return x
+
+
+def dryRun(arch, size):
+    model = build(arch, pretrained=False)
+    probe = Probe()
+    setattr(model, headName(arch, model), probe)
+    #Training mode too, some models return auxiliary outputs only while training
+    outputs = [model.train(training).forward(torch.zeros(2, 3, size, size)) for training in [False, True]]
+    return probe.shapes, outputs
+
+
+def featureSize(arch, size=224):
+    #Dry run on the meta device so nothing is allocated or computed.
+    #None for unknown backbones and for those whose head does not receive flat (N, F) features, which Network needs
+    if arch in feature_sizes:
+        return feature_sizes[arch]
+    if lookup(arch) is None:
+        return None
+    try:
+        with torch.device('meta'):
+            shapes, outputs = dryRun(arch, size)
+    except (RuntimeError, NotImplementedError):
+        #Some operations have no meta implementation, the CPU run also rejects models that cannot take this input size
+        try:
+            with torch.no_grad():
+                shapes, outputs = dryRun(arch, size)
+        except (RuntimeError, ValueError):
+            feature_sizes[arch] = None
+            return None
+    flat = len(shapes) > 0 and all(len(shape) == 2 for shape in shapes) and all(torch.is_tensor(output) for output in outputs)
+    feature_sizes[arch] = shapes[0][1] if flat else None
+    return feature_sizes[arch]
+
+
+def countFlops(model, images):
+    #Multiply-adds of convolution and linear layers counted with forward hooks, reported as FLOPs (2 per multiply-add)
+    total = [0]
+
+    def conv(module, inputs, output):
+        total[0] += 2 * output.numel() * (module.in_channels // module.groups) * module.kernel_size[0] * module.kernel_size[1]
+
+    def linear(module, inputs, output):
+        total[0] += 2 * output.numel() * module.in_features
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            hooks.append(module.register_forward_hook(conv))
+        elif isinstance(module, nn.Linear):
+            hooks.append(module.register_forward_hook(linear))
+    try:
+        with torch.no_grad():
+            model.forward(images)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return total[0] // len(images)
+
+
+def profile(arch, batch_size=1, repeats=5, size=224, device=torch.device("cpu")):
+    #Feature size, FLOPs and forward latency of the backbone without its head, from random weights
+    model = build(arch, pretrained=False)
+    setattr(model, headName(arch, model), nn.Identity())
+    model.eval().to(device)
+    images = torch.randn(batch_size, 3, size, size, device=device)
+    flops = countFlops(model, images[:1])
+    times = []
+    with torch.no_grad():
+        for i in range(repeats + 1):
+            start = time.perf_counter()
+            model.forward(images)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            #The first pass warms up and is not timed
+            if i > 0:
+                times.append(time.perf_counter() - start)
+    return {'arch': arch,
+            'head': headName(arch, model),
+            'features': featureSize(arch, size),
+            'parameters': sum(p.numel() for p in model.parameters()),
+            'gflops': flops / 1e9,
+            'batch_size': batch_size,
+            'ms_per_batch': 1000 * statistics.median(times)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arch',type=str,nargs='+',default=names(), help='Set backbones to profile, default all registered')
+    parser.add_argument('--batch_size',type=int,default=1, help='Set batch size for the latency measurement, default 1')
+    parser.add_argument('--repeats',type=int,default=5, help='Set timed forward passes per backbone, default 5')
+    parser.add_argument('--output',type=str,default='backbones.json', help='Set results file, default backbones.json')
+    in_arg = parser.parse_args()
+    results = []
+    for arch in in_arg.arch:
+        if lookup(arch) is None:
+            print("ERROR Unknown backbone "+arch)
+            continue
+        if featureSize(arch) is None:
+            print("ERROR Backbone "+arch+" does not give flat features to its head")
+            continue
+        result = profile(arch, in_arg.batch_size, in_arg.repeats)
+        results.append(result)
+        print("{}: Head: {}.. Features: {}.. Parameters: {:.1f}M.. {:.2f} GFLOPs/image.. {:.1f} ms/batch of {}".format(
+            arch, result['head'], result['features'], result['parameters'] / 1e6, result['gflops'], result['ms_per_batch'], result['batch_size']))
+    with open(in_arg.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Wrote results to "+in_arg.output)
@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+from PIL import Image
+import myhelper
+import backbones
+import preprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Benchmark:
+
+    def __init__(self, args=None):
+        print("Welcome to the Benchmark")
+        self.in_arg = self.get_input_args(args)
+        torch.manual_seed(0)
+        self.metrics = {}
+        work_dir = self.in_arg.work_dir or tempfile.mkdtemp(prefix='flower_bench_')
+        self.data_dir = os.path.join(work_dir, 'flowers')
+        print("Will benchmark using: Arch: "+self.in_arg.arch+", Work dir: "+work_dir)
+        if not os.path.isdir(self.data_dir):
+            self.synthesize(self.data_dir)
+        self.benchProcessImage()
+        self.benchNetwork()
+        checkpoint = self.benchTraining(work_dir)
+        if checkpoint is not None:
+            self.benchPredict(checkpoint)
+        results = {'config': vars(self.in_arg), 'metrics': self.metrics}
+        with open(self.in_arg.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Wrote results to "+self.in_arg.output)
+        if self.in_arg.baseline is not None and not self.compare(self.in_arg.baseline):
+            sys.exit(1)
+
+    def record(self, name, value, unit, better):
+        self.metrics[name] = {'value': value, 'unit': unit, 'better': better}
+        print("{}: {:.3f} {}".format(name, value, unit))
+
+    def synthesize(self, root):
+        #Smooth random images so JPEG decode cost is closer to real photos than pure noise
+        print("Generating synthetic flowers at "+root)
+        rng = np.random.default_rng(0)
+        counts = {'train': self.in_arg.train_images, 'valid': self.in_arg.valid_images, 'test': self.in_arg.valid_images}
+        for split, per_class in counts.items():
+            for c in range(1, self.in_arg.classes + 1):
+                class_dir = os.path.join(root, split, str(c))
+                os.makedirs(class_dir)
+                for i in range(per_class):
+                    width, height = self.in_arg.resolution
+                    small = rng.integers(0, 256, (max(height // 32, 1), max(width // 32, 1), 3), dtype=np.uint8)
+                    image = Image.fromarray(small).resize((width, height), Image.BILINEAR)
+                    image.save(os.path.join(class_dir, str(i) + '.jpg'), quality=90)
+
+    def images(self):
+        split_dir = os.path.join(self.data_dir, 'valid')
+        return [os.path.join(root, f) for root, dirs, files in os.walk(split_dir) for f in sorted(files)]
+
+    def benchProcessImage(self):
+        #Predict.process_image is preprocess.Preprocessor.process
+        preprocessor = preprocess.Preprocessor()
+        paths = self.images()
+        preprocessor.process(Image.open(paths[0]))
+        start = time.perf_counter()
+        for path in paths:
+            preprocessor.process(Image.open(path))
+        self.record('process_image_ms', 1000 * (time.perf_counter() - start) / len(paths), 'ms/image', 'lower')
+
+    def benchNetwork(self):
+        input_size = backbones.featureSize(self.in_arg.arch)
+        network = myhelper.Network(input_size, self.in_arg.classes, self.in_arg.hidden_units, drop_p=0.5).eval()
+        with torch.no_grad():
+            for batch_size in self.in_arg.batch_sizes:
+                features = torch.randn(batch_size, input_size)
+                network.forward(features)
+                times = []
+                for i in range(self.in_arg.repeats):
+                    start = time.perf_counter()
+                    network.forward(features)
+                    times.append(time.perf_counter() - start)
+                self.record('network_forward_b'+str(batch_size)+'_ms', 1000 * statistics.median(times), 'ms/batch', 'lower')
+
+    def run(self, args):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable] + args, cwd=HERE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        if result.returncode != 0:
+            print(result.stdout[-2000:])
+            return None
+        return time.perf_counter() - start
+
+    def benchTraining(self, work_dir):
+        save_dir = os.path.join(work_dir, '')
+        profile = os.path.join(work_dir, 'train_profile.json')
+        elapsed = self.run(['train.py', '--dir', self.data_dir, '--arch', self.in_arg.arch, '--no_pretrained',
+                            '--epochs', '1', '--save_dir', save_dir, '--profile', profile,
+                            '--batch_size', str(self.in_arg.train_batch_size),
+                            '--hidden_units'] + [str(h) for h in self.in_arg.hidden_units])
+        if elapsed is None:
+            print("ERROR train.py failed, skipping training and predict benchmarks")
+            return None
+        with open(profile, 'r') as f:
+            summary = json.load(f)
+        training = sum(seconds for stage, seconds in summary['stage_seconds'].items() if stage != 'validation')
+        self.record('train_steps_per_sec', summary['steps'] / training, 'steps/sec', 'higher')
+        self.record('train_images_per_sec', summary['images_per_sec'], 'images/sec', 'higher')
+        return os.path.join(save_dir, 'checkpoint.pth')
+
+    def benchPredict(self, checkpoint):
+        image = self.images()[0]
+        times = []
+        for i in range(self.in_arg.predict_runs):
+            elapsed = self.run(['predict.py', '--checkpoint', checkpoint, '--image', image])
+            if elapsed is None:
+                print("ERROR predict.py failed, skipping predict benchmark")
+                return
+            times.append(elapsed)
+        self.record('predict_end_to_end_ms', 1000 * statistics.median(times), 'ms/run', 'lower')
+
+    def compare(self, path):
+        with open(path, 'r') as f:
+            baseline = json.load(f)['metrics']
+        passed = True
+        for name, metric in self.metrics.items():
+            if name not in baseline:
+                continue
+            old, new = baseline[name]['value'], metric['value']
+            change = (new - old) / old if old != 0 else 0.0
+            regressed = change > self.in_arg.threshold if metric['better'] == 'lower' else change < -self.in_arg.threshold
+            print("{} {}: {:.3f} -> {:.3f} ({:+.1%})".format("REGRESSION" if regressed else "ok", name, old, new, change))
+            passed = passed and not regressed
+        return passed
+
+    def get_input_args(self, args=None):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--arch',type=str,default='vgg16',help='Set backbone, any registered in backbones.py, default vgg16')
+        parser.add_argument('--classes',type=int,default=5,help='Set number of synthetic classes, default 5')
+        parser.add_argument('--train_images',type=int,default=16,help='Set training images per class, default 16')
+        parser.add_argument('--valid_images',type=int,default=4,help='Set validation and test images per class, default 4')
+        parser.add_argument('--resolution',type=int,nargs=2,default=[500,375],help='Set width and height of synthetic images, default 500 375')
+        parser.add_argument('--hidden_units',type=int,nargs='+',default=[12544,1568],help='Set hidden units of the benchmarked classifier, default 12544 1568')
+        parser.add_argument('--batch_sizes',type=int,nargs='+',default=[1,8,32,64],help='Set batch sizes for the classifier forward benchmark, default 1 8 32 64')
+        parser.add_argument('--train_batch_size',type=int,default=16,help='Set batch size of the training benchmark, default 16')
+        parser.add_argument('--repeats',type=int,default=10,help='Set timed repeats per classifier batch size, default 10')
+        parser.add_argument('--predict_runs',type=int,default=3,help='Set number of end to end predict.py runs, default 3')
+        parser.add_argument('--work_dir',type=str,help='Set directory for the synthetic data and checkpoint, default a new temporary directory')
+        parser.add_argument('--output',type=str,default='benchmark.json',help='Set results file, default benchmark.json')
+        parser.add_argument('--baseline',type=str,help='Compare against a stored results file and exit non-zero on regressions')
+        parser.add_argument('--threshold',type=float,default=0.1,help='Set allowed relative regression against the baseline, default 0.1')
+        return parser.parse_args(args)
+
+if __name__ == '__main__':
+    Benchmark()
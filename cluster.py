@@ -0,0 +1,86 @@
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import time
+import torch
+import torch.distributed as dist
+
+
+def launch(nproc, argv):
+    #Built-in stand-in for torchrun on a single host, one process per rank with the cores split between them
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    threads = max(1, (os.cpu_count() or 1) // nproc)
+    processes = []
+    for rank in range(nproc):
+        env = dict(os.environ, RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(nproc),
+                   LOCAL_WORLD_SIZE=str(nproc), MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port),
+                   OMP_NUM_THREADS=os.environ.get('OMP_NUM_THREADS', str(threads)))
+        processes.append(subprocess.Popen([sys.executable] + argv + ['--distributed'], env=env))
+    #A rank that dies leaves the others blocked in a collective, so the rest are stopped as soon as one fails
+    try:
+        while True:
+            codes = [process.poll() for process in processes]
+            failed = [code for code in codes if code is not None and code != 0]
+            if len(failed) > 0:
+                return failed[0]
+            if all(code == 0 for code in codes):
+                return 0
+            time.sleep(0.5)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+def setup():
+    #Uses the torchrun style environment, only rank 0 keeps its stdout
+    dist.init_process_group(backend='gloo')
+    rank = dist.get_rank()
+    if 'OMP_NUM_THREADS' in os.environ:
+        torch.set_num_threads(int(os.environ['OMP_NUM_THREADS']))
+    if rank != 0:
+        sys.stdout = open(os.devnull, 'w')
+    return rank, dist.get_world_size(), int(os.environ.get('LOCAL_RANK', 0))
+
+
+def isMain():
+    return not dist.is_available() or not dist.is_initialized() or dist.get_rank() == 0
+
+
+def allReduce(values):
+    #Sums a list of numbers over all ranks
+    tensor = torch.tensor(values, dtype=torch.float64)
+    if dist.is_available() and dist.is_initialized():
+        dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def anyRank(flag):
+    #True on every rank when any rank sets the flag, so all of them take the same branch
+    return allReduce([1.0 if flag else 0.0])[0] > 0
+
+
+@contextlib.contextmanager
+def mainFirst():
+    #Rank 0 runs the block first (e.g. building a cache), the other ranks then reuse its result
+    distributed = dist.is_available() and dist.is_initialized()
+    if distributed and not isMain():
+        dist.barrier()
+    yield
+    if distributed and isMain():
+        dist.barrier()
+
+
+def cleanup():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
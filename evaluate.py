@@ -0,0 +1,88 @@
+import argparse
+import json
+import time
+import torch
+from torch import nn
+from torchvision import datasets
+import myhelper
+import preprocess
+
+
+class Evaluate:
+
+    def __init__(self, args=None):
+        print("Welcome to the Evaluator")
+        self.in_arg = self.get_input_args(args)
+        print("Will evaluate: Checkpoints: "+str(self.in_arg.checkpoints)+", Precisions: "+str(self.in_arg.precisions)+", Path: "+self.in_arg.dir+"/valid")
+        self.device = myhelper.device(self.in_arg.gpu)
+        if self.device is None:
+            print('You selected GPU, but GPU is not available!, closing')
+            return
+        self.dataset = datasets.ImageFolder(self.in_arg.dir + '/valid', transform = preprocess.evalTransforms())
+        self.loader = torch.utils.data.DataLoader(self.dataset, batch_size=self.in_arg.batch_size, num_workers=self.in_arg.workers)
+        results = []
+        for path in self.in_arg.checkpoints:
+            model, checkpoint = myhelper.loadCheckpoint(path, self.device)
+            for precision in self.in_arg.precisions:
+                result = self.evaluate(model, checkpoint, precision)
+                result['checkpoint'] = path
+                results.append(result)
+                print("{}.. {}: Accuracy: {:.4f}.. Loss: {:.3f}.. Throughput: {:.1f} images/sec.. Latency: {:.1f} ms/batch".format(
+                    path, precision, result['accuracy'], result['loss'], result['images_per_sec'], result['ms_per_batch']))
+        self.compare(results)
+        if self.in_arg.output is not None:
+            with open(self.in_arg.output, 'w') as f:
+                json.dump(results, f, indent=2)
+            print("Wrote results to "+self.in_arg.output)
+
+    def evaluate(self, model, checkpoint, precision):
+        device = checkpoint['device']
+        model.eval()
+        #Dataset indices mapped onto the checkpoint's own class indices
+        remap = torch.tensor([checkpoint['class_to_idx'][c] for c in self.dataset.classes])
+        criterion = nn.NLLLoss(reduction='sum')
+        loss, correct, total, batches, seconds, timed = 0.0, 0, 0, 0, 0.0, 0
+        with torch.no_grad(), myhelper.autocast(device, precision):
+            for images, labels in self.loader:
+                images, labels = images.to(device), remap[labels].to(device)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                output = model.forward(images).float()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                #The first batch warms up kernels and allocations and is left out of the timing
+                if batches > 0:
+                    seconds += time.perf_counter() - start
+                    timed += len(labels)
+                batches += 1
+                loss += criterion(output, labels).item()
+                correct += (output.max(dim=1)[1] == labels).sum().item()
+                total += len(labels)
+        return {'precision': precision,
+                'accuracy': correct / total,
+                'loss': loss / total,
+                'images_per_sec': timed / seconds if seconds > 0 else 0.0,
+                'ms_per_batch': 1000 * seconds / max(batches - 1, 1)}
+
+    def compare(self, results):
+        reference = results[0]
+        for result in results[1:]:
+            print("{} {} vs {} {}: Accuracy delta: {:+.4f}.. Speed-up: {:.2f}x".format(
+                result['checkpoint'], result['precision'], reference['checkpoint'], reference['precision'],
+                result['accuracy'] - reference['accuracy'],
+                result['images_per_sec'] / reference['images_per_sec'] if reference['images_per_sec'] > 0 else 0.0))
+
+    def get_input_args(self, args=None):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--checkpoints',type=str,nargs='+', help='<Required>Set checkpoints to evaluate, the first is the reference', required=True)
+        parser.add_argument('--precisions',type=str,nargs='+',default=['fp32','bf16'],choices=['fp32','bf16','fp16'], help='Set precisions to evaluate each checkpoint with, default fp32 bf16')
+        parser.add_argument('--dir',type=str,default='flowers', help='Path to images folder, its valid split is used')
+        parser.add_argument('--batch_size',type=int,default=32, help='Set batch size, default 32')
+        parser.add_argument('--workers',type=int,default=0, help='Set data loading workers, default 0')
+        parser.add_argument('--output',type=str, help='Write the results to this JSON file')
+        parser.add_argument('--gpu',type=str, default="no", help='Set yes to use GPU, default CPU')
+        return parser.parse_args(args)
+
+if __name__ == '__main__':
+    Evaluate()
@@ -0,0 +1,127 @@
+import argparse
+import importlib.util
+import json
+import os
+import time
+import torch
+from torch import nn
+from torchvision import datasets
+import myhelper
+import preprocess
+
+
+class Export:
+
+    def __init__(self, args=None):
+        print("Welcome to the Exporter")
+        self.in_arg = self.get_input_args(args)
+        extensions = {'int8': '.int8.pth', 'fp16': '.fp16.pth', 'torchscript': '.pt', 'onnx': '.onnx', 'mmap': '.mmap'}
+        output = self.in_arg.output or os.path.splitext(self.in_arg.checkpoint)[0] + extensions[self.in_arg.format]
+        print("Will export: Checkpoint: "+str(self.in_arg.checkpoint)+", Format: "+self.in_arg.format+", Output: "+output)
+        if self.in_arg.format in ['torchscript', 'onnx']:
+            self.exportArtifact(output)
+            return
+        if self.in_arg.format == 'mmap':
+            self.exportMapped(output)
+            return
+        self.checkpoint = torch.load(self.in_arg.checkpoint, map_location=lambda storage, loc: storage)
+        if self.checkpoint.get('format', 'fp32') != 'fp32':
+            print("ERROR Export needs an fp32 checkpoint, got "+self.checkpoint['format'])
+            return
+        self.classifier = myhelper.buildClassifier(self.checkpoint).eval()
+        self.compact = self.exportClassifier(output)
+        print("Size: {:.1f} MB -> {:.1f} MB".format(os.path.getsize(self.in_arg.checkpoint) / 2**20, os.path.getsize(output) / 2**20))
+        if self.in_arg.dir is not None:
+            self.report()
+
+    def exportClassifier(self, output):
+        checkpoint = dict(self.checkpoint)
+        checkpoint['format'] = self.in_arg.format
+        if self.in_arg.format == 'int8':
+            compact = myhelper.quantize(self.classifier)
+            checkpoint['state_dict'] = compact.state_dict()
+        else:
+            checkpoint['state_dict'] = {key: value.half() for key, value in self.classifier.state_dict().items()}
+            compact = myhelper.buildClassifier(checkpoint).eval()
+        torch.save(checkpoint, output)
+        return compact
+
+    def exportMapped(self, output):
+        model, checkpoint = myhelper.loadCheckpoint(self.in_arg.checkpoint, torch.device("cpu"))
+        if checkpoint.get('format', 'fp32') != 'fp32':
+            print("ERROR mmap export needs an fp32 checkpoint, got "+checkpoint['format'])
+            return
+        del checkpoint['device']
+        myhelper.saveMapped(output, model, checkpoint)
+        print("Size: {:.1f} MB".format(os.path.getsize(output) / 2**20))
+
+    def exportArtifact(self, output):
+        #Backbone, head, preprocessing constants and class_to_idx in one file that loads without torchvision
+        model, checkpoint = myhelper.loadCheckpoint(self.in_arg.checkpoint, torch.device("cpu"))
+        model.eval()
+        meta = {'model': checkpoint['model'],
+                'format': checkpoint.get('format', 'fp32'),
+                'class_to_idx': checkpoint['class_to_idx'],
+                'mean': preprocess.mean,
+                'sd': preprocess.sd,
+                'size': 224,
+                'resize': 256}
+        example = torch.zeros(1, 3, 224, 224)
+        with torch.no_grad():
+            if self.in_arg.format == 'torchscript':
+                traced = torch.jit.freeze(torch.jit.trace(model, example))
+                torch.jit.save(traced, output, _extra_files={'meta.json': json.dumps(meta)})
+            else:
+                if meta['format'] == 'int8':
+                    print("ERROR ONNX export needs an fp32 or fp16 checkpoint")
+                    return
+                if importlib.util.find_spec('onnx') is None:
+                    print("ERROR ONNX export needs the onnx package, and predicting from it needs onnxruntime")
+                    return
+                torch.onnx.export(model, example, output, input_names=['images'], output_names=['log_probs'],
+                                  dynamic_axes={'images': {0: 'batch'}, 'log_probs': {0: 'batch'}})
+                with open(output + '.json', 'w') as f:
+                    json.dump(meta, f)
+        print("Size: {:.1f} MB".format(os.path.getsize(output) / 2**20))
+
+    def report(self):
+        #Runs the backbone once per batch and scores both heads on the same features
+        print("Comparing heads on "+self.in_arg.dir+"/valid")
+        model = myhelper.loadBackbone(self.checkpoint)
+        myhelper.setHead(model, self.checkpoint['model'], nn.Identity())
+        model.eval()
+        dataset = datasets.ImageFolder(self.in_arg.dir + '/valid', transform = preprocess.evalTransforms())
+        loader = torch.utils.data.DataLoader(dataset, batch_size=self.in_arg.batch_size, num_workers=self.in_arg.workers)
+        heads = {'fp32': self.classifier, self.in_arg.format: self.compact}
+        correct = {name: 0 for name in heads}
+        seconds = {name: 0.0 for name in heads}
+        agree, total = 0, 0
+        with torch.no_grad():
+            for images, labels in loader:
+                features = model.forward(images)
+                predictions = {}
+                for name, head in heads.items():
+                    start = time.perf_counter()
+                    predictions[name] = head.forward(features).max(dim=1)[1]
+                    seconds[name] += time.perf_counter() - start
+                    correct[name] += (predictions[name] == labels).sum().item()
+                agree += (predictions['fp32'] == predictions[self.in_arg.format]).sum().item()
+                total += len(labels)
+        for name in heads:
+            print("{}: Accuracy: {:.4f}.. Head time: {:.3f}s".format(name, correct[name] / total, seconds[name]))
+        print("Accuracy delta: {:+.4f}.. Top-1 agreement: {:.4f}.. Head speed-up: {:.2f}x".format(
+            (correct[self.in_arg.format] - correct['fp32']) / total, agree / total,
+            seconds['fp32'] / max(seconds[self.in_arg.format], 1e-9)))
+
+    def get_input_args(self, args=None):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--checkpoint',type=str, help='<Required>Set path to a checkpoint from train.py', required=True)
+        parser.add_argument('--format',type=str,default='int8',choices=['int8','fp16','torchscript','onnx','mmap'], help='Set export format: int8 (dynamic quantized, CPU) or fp16 heads, a self-contained torchscript/onnx model, or a memory-mapped fp32 checkpoint, default int8')
+        parser.add_argument('--output',type=str, help='Set output path, default <checkpoint>.<format>.pth')
+        parser.add_argument('--dir',type=str, help='Set images folder to report the accuracy delta on its valid split')
+        parser.add_argument('--batch_size',type=int,default=32, help='Set batch size for the report, default 32')
+        parser.add_argument('--workers',type=int,default=0, help='Set data loading workers for the report, default 0')
+        return parser.parse_args(args)
+
+if __name__ == '__main__':
+    Export()
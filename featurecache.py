@@ -0,0 +1,92 @@
+import os
+import json
+import numpy as np
+import torch
+from torch import nn
+import myhelper
+
+
+class FeatureStore(torch.utils.data.Dataset):
+    #Memory-mapped backbone features, one row per image per augmented view
+    def __init__(self, prefix):
+        with open(prefix + '.json', 'r') as f:
+            self.meta = json.load(f)
+        self.features = np.load(prefix + '.features.npy', mmap_mode='r')
+        self.labels = np.load(prefix + '.labels.npy', mmap_mode='r')
+        self.count = self.meta['count']
+        self.views = self.meta['views']
+        self.class_to_idx = self.meta['class_to_idx']
+        self.view = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        row = self.view * self.count + index
+        features = torch.from_numpy(np.array(self.features[row], dtype=np.float32))
+        return features, int(self.labels[row])
+
+
+def storePrefix(feature_dir, arch, split):
+    return os.path.join(feature_dir, arch + '_' + split)
+
+
+def isCurrent(prefix, arch, views, dtype, count, source=None):
+    #Features of a random backbone are never reused, another run's backbone may differ
+    if not os.path.isfile(prefix + '.json') or (source is not None and source.get('random')):
+        return False
+    with open(prefix + '.json', 'r') as f:
+        meta = json.load(f)
+    return (meta['arch'] == arch and meta['views'] == views and meta['dtype'] == dtype and meta['count'] == count
+            and meta.get('source') == source)
+
+
+def buildFeatures(model, dataset, prefix, arch, views, half, device, loader_args=None, source=None):
+    #Runs the frozen backbone over the dataset once per view and writes the features to disk.
+    #source describes the backbone weights and preprocessing, features from any other source are rebuilt
+    dtype = 'float16' if half else 'float32'
+    if loader_args is None:
+        loader_args = {'batch_size': 64}
+    count = len(dataset)
+    if isCurrent(prefix, arch, views, dtype, count, source):
+        print("Reusing cached features at "+prefix)
+        return FeatureStore(prefix)
+
+    if os.path.isfile(prefix + '.json'):
+        os.remove(prefix + '.json')
+    print("Caching "+str(views)+" view(s) of "+str(count)+" images at "+prefix)
+    classifier = myhelper.getHead(model, arch)
+    myhelper.setHead(model, arch, nn.Identity())
+    model.eval()
+    features = None
+    labels = np.lib.format.open_memmap(prefix + '.labels.npy', mode='w+', dtype=np.int64, shape=(views * count,))
+    try:
+        with torch.no_grad():
+            for view in range(views):
+                #Fixed order so row i of every view is the same image
+                loader = torch.utils.data.DataLoader(dataset, shuffle=False, **loader_args)
+                row = view * count
+                for images, targets in loader:
+                    output = model.forward(images.to(device, non_blocking=True)).flatten(1).cpu().numpy()
+                    if features is None:
+                        features = np.lib.format.open_memmap(prefix + '.features.npy', mode='w+', dtype=dtype, shape=(views * count, output.shape[1]))
+                    features[row:row + len(output)] = output
+                    labels[row:row + len(output)] = targets.numpy()
+                    row += len(output)
+                print("View "+str(view+1)+"/"+str(views)+" done")
+    finally:
+        myhelper.setHead(model, arch, classifier)
+    features.flush()
+    labels.flush()
+    del features, labels
+
+    meta = {'arch': arch,
+            'views': views,
+            'dtype': dtype,
+            'count': count,
+            'source': source,
+            'feature_size': int(np.load(prefix + '.features.npy', mmap_mode='r').shape[1]),
+            'class_to_idx': dataset.class_to_idx}
+    with open(prefix + '.json', 'w') as f:
+        json.dump(meta, f)
+    return FeatureStore(prefix)
@@ -0,0 +1,114 @@
+import argparse
+import os
+import json
+import multiprocessing
+import numpy as np
+import torch
+from torchvision import datasets
+from PIL import Image
+import myhelper
+import preprocess
+
+
+def decode(args):
+    path, short_side = args
+    image = preprocess.openImage(path, short_side).convert('RGB')
+    width, height = image.size
+    scale = short_side / min(width, height)
+    image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def isCurrent(cache_dir, split, short_side, split_dir):
+    #The cache must come from the same images of the same folder
+    meta_path = os.path.join(cache_dir, split + '.json')
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    return meta['short_side'] == short_side and meta.get('source') == myhelper.folderSource(split_dir, datasets.ImageFolder(split_dir).samples)
+
+
+def buildCache(split_dir, cache_dir, split, short_side=256, shard_mb=512, workers=1):
+    #Decodes every image of an ImageFolder split once and packs the resized uint8 pixels into shard files
+    folder = datasets.ImageFolder(split_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    meta_path = os.path.join(cache_dir, split + '.json')
+    if os.path.isfile(meta_path):
+        os.remove(meta_path)
+    print("Caching "+str(len(folder.samples))+" images from "+split_dir+" at short side "+str(short_side))
+
+    shard_bytes = shard_mb * 1024 * 1024
+    index = np.zeros((len(folder.samples), 5), dtype=np.int64)
+    shard, offset = 0, 0
+    out = open(os.path.join(cache_dir, split + '_' + str(shard) + '.bin'), 'wb')
+    jobs = [(path, short_side) for path, label in folder.samples]
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        decoded = pool.imap(decode, jobs, chunksize=16) if pool is not None else map(decode, jobs)
+        for i, pixels in enumerate(decoded):
+            if offset > 0 and offset + pixels.nbytes > shard_bytes:
+                out.close()
+                shard, offset = shard + 1, 0
+                out = open(os.path.join(cache_dir, split + '_' + str(shard) + '.bin'), 'wb')
+            out.write(pixels.tobytes())
+            index[i] = [shard, offset, pixels.shape[0], pixels.shape[1], folder.samples[i][1]]
+            offset += pixels.nbytes
+    finally:
+        out.close()
+        if pool is not None:
+            pool.close()
+    np.save(os.path.join(cache_dir, split + '_index.npy'), index)
+    meta = {'short_side': short_side,
+            'source': myhelper.folderSource(split_dir, folder.samples),
+            'shards': shard + 1,
+            'count': len(folder.samples),
+            'classes': folder.classes,
+            'class_to_idx': folder.class_to_idx}
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    print("Wrote "+str(shard + 1)+" shard(s) to "+cache_dir)
+
+
+class CachedImageFolder(torch.utils.data.Dataset):
+    #Drop-in replacement for datasets.ImageFolder that reads pre-decoded pixels from buildCache shards
+    def __init__(self, cache_dir, split, transform=None):
+        with open(os.path.join(cache_dir, split + '.json'), 'r') as f:
+            meta = json.load(f)
+        self.cache_dir = cache_dir
+        self.split = split
+        self.transform = transform
+        self.classes = meta['classes']
+        self.class_to_idx = meta['class_to_idx']
+        self.index = np.load(os.path.join(cache_dir, split + '_index.npy'))
+        self.targets = self.index[:, 4].tolist()
+        self.shard_count = meta['shards']
+        self.shards = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        #Mapped lazily so every data loader worker opens its own maps
+        if self.shards is None:
+            self.shards = [np.memmap(os.path.join(self.cache_dir, self.split + '_' + str(n) + '.bin'), dtype=np.uint8, mode='r')
+                           for n in range(self.shard_count)]
+        shard, offset, height, width, label = self.index[i]
+        pixels = self.shards[shard][offset:offset + height * width * 3].reshape(height, width, 3)
+        image = Image.fromarray(np.array(pixels))
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, int(label)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir',type=str,default='flowers', help='Path to images folder with train, valid and test')
+    parser.add_argument('--out',type=str,default='image_cache', help='Set directory for the cache, default image_cache')
+    parser.add_argument('--short_side',type=int,default=256, help='Set short side of the stored images, default 256')
+    parser.add_argument('--shard_mb',type=int,default=512, help='Set shard file size in MB, default 512')
+    parser.add_argument('--workers',type=int,default=1, help='Set number of decoding processes, default 1')
+    in_arg = parser.parse_args()
+    for split in ['train', 'valid', 'test']:
+        buildCache(os.path.join(in_arg.dir, split), in_arg.out, split, in_arg.short_side, in_arg.shard_mb, in_arg.workers)
@@ -0,0 +1,101 @@
+import json
+import time
+import torch
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class StepTimer:
+    #Accumulates wall time per training stage between successive lap() calls
+    def __init__(self, device, detailed=False):
+        self.device = device
+        self.detailed = detailed
+        self.run = {}
+        self.run_steps = 0
+        self.run_images = 0
+        self.started = time.perf_counter()
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.steps = 0
+        self.images = 0
+        self.mark()
+
+    def sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def mark(self):
+        self.last = time.perf_counter()
+
+    def lap(self, stage, sync=False):
+        if sync:
+            self.sync()
+        now = time.perf_counter()
+        self.totals[stage] = self.totals.get(stage, 0.0) + now - self.last
+        self.run[stage] = self.run.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def detail(self, stage):
+        #Fine-grained stages need a sync each, so they are only timed when profiling
+        if self.detailed:
+            self.lap(stage, sync=True)
+
+    def step(self, images):
+        self.steps += 1
+        self.images += images
+        self.run_steps += 1
+        self.run_images += images
+
+    def boundReport(self, threshold=0.2):
+        total = sum(seconds for stage, seconds in self.totals.items() if stage != 'validation')
+        if total == 0:
+            return "No steps timed"
+        data = self.totals.get('data', 0.0)
+        verdict = "input-bound, try more --workers or a larger --prefetch" if data / total > threshold else "compute-bound"
+        return "Data wait: {:.1f}s ({:.0%}), compute: {:.1f}s, {:.1f} images/sec, {}".format(
+            data, data / total, total - data, self.images / total, verdict)
+
+    def peakMemory(self):
+        if self.device.type == 'cuda':
+            return torch.cuda.max_memory_allocated(self.device) / 2**20
+        if resource is not None:
+            #ru_maxrss is in kilobytes on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return None
+
+    def summary(self, config=None):
+        training = sum(seconds for stage, seconds in self.run.items() if stage != 'validation')
+        return {'config': config or {},
+                'wall_seconds': time.perf_counter() - self.started,
+                'steps': self.run_steps,
+                'images': self.run_images,
+                'images_per_sec': self.run_images / training if training > 0 else 0.0,
+                'stage_seconds': self.run,
+                'stage_ms_per_step': {stage: 1000 * seconds / max(self.run_steps, 1) for stage, seconds in self.run.items() if stage != 'validation'},
+                'peak_memory_mb': self.peakMemory()}
+
+    def writeSummary(self, path, config=None):
+        summary = self.summary(config)
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print("Wrote run summary to "+path)
+        return summary
+
+
+def traceProfiler(path, steps=5):
+    #torch.profiler over a short window of training steps, exported as a Chrome trace
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(activities=activities,
+                                  schedule=torch.profiler.schedule(wait=1, warmup=1, active=steps, repeat=1),
+                                  on_trace_ready=lambda profiler: profiler.export_chrome_trace(path),
+                                  profile_memory=True,
+                                  record_shapes=True)
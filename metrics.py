@@ -0,0 +1,27 @@
+import torch
+import cluster
+
+
+class Metrics:
+    #Sample-weighted loss and accuracy kept on the device, read back with a single sync per pass
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        #Loss sum, correct predictions, samples
+        self.totals = torch.zeros(3, dtype=torch.float64, device=self.device)
+
+    def update(self, output, labels, loss):
+        #loss is the batch mean, weighted back to a sum so a short last batch counts by its size
+        count = labels.size(0)
+        self.totals += torch.stack([loss.detach().double() * count,
+                                    (output.argmax(dim=1) == labels).sum().double(),
+                                    torch.tensor(float(count), dtype=torch.float64, device=self.device)])
+
+    def compute(self):
+        #Summed over all ranks, then averaged per sample
+        loss, correct, count = cluster.allReduce(self.totals.tolist())
+        if count == 0:
+            return 0.0, 0.0
+        return loss / count, correct / count
@@ -1,6 +1,13 @@
+import contextlib
+import hashlib
+import json
+import os
+import struct
+import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
+import backbones
 
 
 def device(gpu):
@@ -12,6 +19,77 @@ def device(gpu):
     else:
         return torch.device("cpu")
 
+dtypes = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def autocast(device, precision):
+    #Mixed precision forward passes, matmuls and convolutions run in bf16/fp16, reductions stay fp32
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtypes[precision])
+
+def gradScaler(device, precision):
+    #Loss scaling keeps small fp16 gradients from underflowing, bf16 has fp32 range and needs none
+    enabled = precision == 'fp16'
+    try:
+        return torch.amp.GradScaler(device.type, enabled=enabled)
+    except (AttributeError, TypeError):
+        return torch.cuda.amp.GradScaler(enabled=enabled and device.type == 'cuda')
+
+def fingerprint(path, *extra, sample=2**20):
+    #Cheap identity of a checkpoint file from its size, mtime and the bytes at both ends, changes whenever the file is rewritten
+    stat = os.stat(path)
+    digest = hashlib.sha1('|'.join([os.path.abspath(path), str(stat.st_size), str(stat.st_mtime_ns)] + [str(e) for e in extra]).encode('utf-8'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(sample))
+        if stat.st_size > sample:
+            f.seek(max(stat.st_size - sample, sample))
+            digest.update(f.read(sample))
+    return digest.hexdigest()
+
+def folderSource(split_dir, samples):
+    #Identity of an ImageFolder split from its location and sample list, caches built from it notice added, removed or relabelled images
+    digest = hashlib.sha1()
+    for path, label in samples:
+        digest.update((os.path.relpath(path, split_dir) + '|' + str(label) + '\n').encode('utf-8'))
+    return {'dir': os.path.abspath(split_dir), 'count': len(samples), 'samples': digest.hexdigest()}
+
+def optimize(model, mode, device, example=None, cache_dir='.compile_cache', key=None):
+    #Graph-level optimization of a model, falling back to the eager model whenever compiling is not possible
+    if mode == 'none':
+        return model
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    if example is not None and example.dim() == 4:
+        model = model.to(memory_format=torch.channels_last)
+        example = example.to(device, memory_format=torch.channels_last)
+    if mode == 'script':
+        path = os.path.join(cache_dir, key + '.pt') if key is not None else None
+        if path is not None and os.path.isfile(path):
+            print("Loading compiled model from "+path)
+            return torch.jit.load(path, map_location=device)
+        try:
+            with torch.no_grad():
+                compiled = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+        except Exception as error:
+            print("TorchScript compilation failed, running eagerly: "+str(error))
+            return model
+        if path is not None:
+            torch.jit.save(compiled, path)
+        return compiled
+    if not hasattr(torch, 'compile'):
+        print("torch.compile needs PyTorch 2 or later, running eagerly")
+        return model
+    #Compiled kernels and graphs are kept on disk so later starts skip recompiling
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+    try:
+        from torch._dynamo import config as dynamo_config
+        from torch._inductor import config as inductor_config
+        dynamo_config.suppress_errors = True
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+    return torch.compile(model, backend='inductor')
+
 class Network(nn.Module):
     def __init__(self, input_size, output_size, hidden_layers, drop_p):
         super().__init__()
@@ -27,4 +105,150 @@ class Network(nn.Module):
             x = F.relu(linear(x))
             x = self.dropout(x)
         x = self.output(x)    
-        return F.log_softmax(x, dim=1) 
\ No newline at end of file
+        return F.log_softmax(x, dim=1)
+
+
+def backbone(arch, pretrained=True, weights=None):
+    #weights is a locally saved torchvision state_dict, used instead of downloading pretrained weights
+    model = backbones.build(arch, pretrained and weights is None)
+    if model is None:
+        return None
+    if weights is not None:
+        model.load_state_dict(torch.load(weights, map_location=lambda storage, loc: storage))
+    for params in model.parameters():
+        params.requires_grad = False
+    return model
+
+def headName(model, arch):
+    return backbones.headName(arch, model)
+
+def getHead(model, arch):
+    return getattr(model, headName(model, arch))
+
+def setHead(model, arch, head):
+    setattr(model, headName(model, arch), head)
+
+def loadBackbone(checkpoint):
+    #The backbone a checkpoint was trained on, fine-tuned backbones are stored in the checkpoint itself
+    finetuned = 'backbone_state_dict' in checkpoint
+    weights = checkpoint.get('backbone_weights') if not finetuned else None
+    if weights is not None and not os.path.isfile(weights):
+        raise ValueError("Backbone weights of the checkpoint not found: "+weights)
+    if not finetuned and weights is None and not checkpoint.get('pretrained', True):
+        raise ValueError("Checkpoint was trained on a random backbone that was not saved, retrain it")
+    model = backbone(checkpoint['model'], checkpoint.get('pretrained', True) and not finetuned, weights)
+    if model is None:
+        raise ValueError("Unknown model in checkpoint: "+str(checkpoint['model']))
+    if finetuned:
+        #The head is not part of the saved backbone weights
+        missing, unexpected = model.load_state_dict(checkpoint['backbone_state_dict'], strict=False)
+        if len(unexpected) > 0 or any(not key.startswith(headName(model, checkpoint['model']) + '.') for key in missing):
+            raise ValueError("Backbone weights of the checkpoint do not match "+str(checkpoint['model']))
+        for params in model.parameters():
+            params.requires_grad = False
+    return model
+
+def quantize(classifier):
+    #Dynamic int8 quantization of the Linear layers, weights are stored as int8 and activations quantized on the fly
+    return torch.quantization.quantize_dynamic(classifier.eval(), {nn.Linear}, dtype=torch.qint8)
+
+def buildClassifier(checkpoint):
+    classifier = Network(checkpoint['input_size'], checkpoint['output_size'], checkpoint['hidden_layers'], drop_p=checkpoint['drop'])
+    if checkpoint.get('format') == 'int8':
+        classifier = quantize(classifier)
+    #fp16 weights are cast back to the fp32 parameters on load
+    classifier.load_state_dict(checkpoint['state_dict'])
+    return classifier
+
+class OnnxModel:
+    #Minimal module-like wrapper so an ONNX Runtime session can stand in for the torch model
+    def __init__(self, path):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+    def forward(self, images):
+        return torch.from_numpy(self.session.run(None, {self.input: images.cpu().numpy()})[0])
+
+    __call__ = forward
+
+def loadArtifact(path, device):
+    #Loads a traced artifact from export.py, nothing is rebuilt
+    if path.endswith('.onnx'):
+        with open(path + '.json', 'r') as f:
+            info = json.load(f)
+        model = OnnxModel(path)
+        device = torch.device("cpu")
+    else:
+        extra_files = {'meta.json': ''}
+        model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        info = json.loads(extra_files['meta.json'])
+        if info.get('format') == 'int8':
+            device = torch.device("cpu")
+    info['device'] = device
+    return model, info
+
+def saveMapped(path, model, info, alignment=64):
+    #Layout: 8 byte header length, JSON header, then every tensor aligned and back to back
+    state = {key: value.detach().cpu().contiguous() for key, value in model.state_dict().items()}
+    tensors, offset = {}, 0
+    for key, value in state.items():
+        nbytes = value.numel() * value.element_size()
+        tensors[key] = {'dtype': str(value.numpy().dtype), 'shape': list(value.shape), 'offset': offset, 'nbytes': nbytes}
+        offset += -(-nbytes // alignment) * alignment
+    header = json.dumps({'info': info, 'tensors': tensors}).encode('utf-8')
+    start = -(-(8 + len(header)) // alignment) * alignment
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', start - 8))
+        f.write(header.ljust(start - 8))
+        for key, value in state.items():
+            f.seek(start + tensors[key]['offset'])
+            f.write(value.numpy().tobytes())
+
+def loadMapped(path, device):
+    #Parameters are bound straight to the mapped file, so processes on one host share the same pages
+    with open(path, 'rb') as f:
+        length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(length).decode('utf-8'))
+    start = 8 + length
+    buffer = np.memmap(path, dtype=np.uint8, mode='c')
+    state = {}
+    for key, tensor in header['tensors'].items():
+        begin = start + tensor['offset']
+        array = buffer[begin:begin + tensor['nbytes']].view(np.dtype(tensor['dtype'])).reshape(tensor['shape'])
+        state[key] = torch.from_numpy(array)
+    info = header['info']
+    print("Loading model "+str(info['model']))
+    with torch.device("meta"):
+        model = backbone(info['model'], pretrained=False)
+        setHead(model, info['model'], Network(info['input_size'], info['output_size'], info['hidden_layers'], drop_p=info['drop']))
+    model.load_state_dict(state, assign=True)
+    for params in model.parameters():
+        params.requires_grad = False
+    model.to(device)
+    info['device'] = device
+    return model, info
+
+def loadCheckpoint(path, device):
+    if os.path.splitext(path)[1] in ['.pt', '.onnx']:
+        return loadArtifact(path, device)
+    if path.endswith('.mmap'):
+        return loadMapped(path, device)
+    checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+    classifier = buildClassifier(checkpoint)
+    print("Loading model "+str(checkpoint['model']))
+    model = loadBackbone(checkpoint)
+    if checkpoint.get('format') == 'int8' and device.type != 'cpu':
+        print("int8 checkpoints run on CPU only, using CPU")
+        device = torch.device("cpu")
+    setHead(model, checkpoint['model'], classifier)
+    model.to(device)
+    info = {key: value for key, value in checkpoint.items() if key not in ['state_dict', 'backbone_state_dict']}
+    info['device'] = device
+    return model, info
@@ -1,19 +1,33 @@
 import argparse
+import collections
 import torch
-from torchvision import datasets, transforms, models
-import numpy as np
 from PIL import Image
 import json
+import glob
+import io
+import itertools
+import os
+import sys
+import time
 import myhelper
+import server
+import preprocess
+import resultcache
+import tarshards
+import workerpool
 
 class Predict:
     mean = [0.485, 0.456, 0.406]
     sd = [0.229, 0.224, 0.225]
     
-    def __init__(self):
+    def __init__(self, args=None):
         print("Welcome to the Predictor")
-        self.in_arg = self.get_input_args()
-        print("Will run predictor using: Checkpoint: "+str(self.in_arg.checkpoint)+", Image: "+str(self.in_arg.image) +", Top_K: "+str(self.in_arg.top_k))
+        self.in_arg = self.get_input_args(args)
+        self.preprocessor = preprocess.Preprocessor(mean=self.mean, sd=self.sd, draft=self.in_arg.draft)
+        if [self.in_arg.image is not None, self.in_arg.images is not None, self.in_arg.serve].count(True) != 1:
+            print("ERROR Set one of --image, --images or --serve")
+            return
+        print("Will run predictor using: Checkpoint: "+str(self.in_arg.checkpoint)+", Image: "+str(self.in_arg.image or self.in_arg.images) +", Top_K: "+str(self.in_arg.top_k))
         with open(self.in_arg.category_names, 'r') as f:
             self.cat_to_name = json.load(f)
         #Set device
@@ -24,8 +38,37 @@ class Predict:
         print("Using Device: "+str(self.device))
         print("Loading checkpoint")
         self.checkpoint = self.loadCheckPoint()
+        self.stages = self.loadStages()
+        if self.stages is None:
+            return
+        #Results of repeated images are served from memory, and from disk across runs
+        self.cache = None
+        if self.in_arg.cache > 0 or self.in_arg.cache_db is not None:
+            fingerprint = resultcache.fingerprint([self.in_arg.checkpoint] + (self.in_arg.cascade or []), [stage['precision'] for stage in self.stages],
+                                                  self.in_arg.threshold, self.in_arg.margin, self.in_arg.draft, self.in_arg.compile)
+            self.cache = resultcache.ResultCache(fingerprint, max(self.in_arg.cache, 1), self.in_arg.cache_db)
+        if self.in_arg.serve:
+            server.PredictServer(self, self.in_arg.max_batch_size, self.in_arg.max_delay).serve(self.in_arg.host, self.in_arg.port, self.in_arg.socket)
+            return
+        if self.in_arg.images is not None:
+            self.runBatch()
+            return
         print("Predicting")
-        probs, classes = self.predict(self.in_arg.image, self.model, self.in_arg.top_k)
+        key, cached = None, None
+        if self.cache is not None:
+            with open(self.in_arg.image, 'rb') as f:
+                key = self.cache.key(f.read(), self.in_arg.top_k)
+            cached = self.cache.get(key)
+        if cached is not None:
+            probs, classes = cached['probabilities'], cached['classes']
+        else:
+            if len(self.stages) > 1:
+                probs, classes = self.predictBatch(self.process_image(Image.open(self.in_arg.image)).unsqueeze(0), self.model, self.in_arg.top_k)[0]
+                self.cascadeReport()
+            else:
+                probs, classes = self.predict(self.in_arg.image, self.model, self.in_arg.top_k)
+            if key is not None:
+                self.cache.put(key, self.describe(classes, probs))
         #categories = [ self.in_arg.cat_to_name[i] for i in classes ]
         for key,value in enumerate(probs):
             print("Class: "+classes[key]+", Flower: "+str(self.cat_to_name[classes[key]])+", Probability: "+str(value))
@@ -34,10 +77,10 @@ class Predict:
         self.model.eval()
         image = self.process_image(Image.open(image_path))
         image = image.unsqueeze(0)
-        image = image.float()    
-        image = image.to(self.device)
+        image = image.to(self.device, memory_format=self.memory_format)
         print(image.shape)
-        output = model.forward(image)
+        with myhelper.autocast(self.device, self.precision):
+            output = model.forward(image).float()
         ps = torch.exp(output)
         
         probs, indices = torch.topk(ps, topk)
@@ -59,70 +102,278 @@ class Predict:
         classes = [ idx_to_class[i] for i in indices ]
         return probs, classes
 
+    def predictBatch(self, images, model, topk):
+        #Runs a stacked batch of processed images, returns probabilities and classes per image
+        if len(self.stages) > 1:
+            return self.predictCascade(images, topk)
+        model.eval()
+        with torch.no_grad(), myhelper.autocast(self.device, self.precision):
+            output = model.forward(images.to(self.device, memory_format=self.memory_format)).float()
+        probs, indices = torch.topk(torch.exp(output), topk)
+        probs = probs.cpu().numpy()
+        indices = indices.cpu().numpy()
+        idx_to_class = {i:c for c,i in self.checkpoint['class_to_idx'].items() }
+        return [(probs[row], [ idx_to_class[i] for i in indices[row] ]) for row in range(len(indices))]
+
+    def predictCascade(self, images, topk):
+        #Each image stops at the first stage confident about it, the rest are re-batched for the next stage
+        probabilities = [None] * len(images)
+        remaining = torch.arange(len(images))
+        for n, stage in enumerate(self.stages):
+            batch = images[remaining]
+            start = time.perf_counter()
+            with torch.no_grad(), myhelper.autocast(stage['device'], stage['precision']):
+                ps = torch.exp(stage['model'].forward(batch.to(stage['device'], memory_format=stage['memory_format'])).float()).cpu()
+            stage['seconds'] += time.perf_counter() - start
+            stage['images'] += len(remaining)
+            top = torch.topk(ps, min(2, ps.shape[1])).values
+            margin = top[:, 0] - top[:, 1] if top.shape[1] > 1 else top[:, 0]
+            confident = (top[:, 0] >= self.in_arg.threshold) & (margin >= self.in_arg.margin)
+            if n == len(self.stages) - 1:
+                confident[:] = True
+            for row in torch.nonzero(confident).flatten().tolist():
+                probabilities[remaining[row]] = ps[row]
+            stage['accepted'] += int(confident.sum())
+            remaining = remaining[~confident]
+            if len(remaining) == 0:
+                break
+        probs, indices = torch.topk(torch.stack(probabilities), topk)
+        probs = probs.numpy()
+        indices = indices.numpy()
+        idx_to_class = {i:c for c,i in self.checkpoint['class_to_idx'].items() }
+        return [(probs[row], [ idx_to_class[i] for i in indices[row] ]) for row in range(len(indices))]
+
+    def cascadeStats(self):
+        total = self.stages[0]['images']
+        stats = {'images': total,
+                 'ms_per_image': 1000 * sum(stage['seconds'] for stage in self.stages) / max(total, 1),
+                 'stages': []}
+        for stage in self.stages:
+            stats['stages'].append({'checkpoint': stage['path'],
+                                    'images': stage['images'],
+                                    'accepted': stage['accepted'],
+                                    'hit_rate': stage['accepted'] / stage['images'] if stage['images'] > 0 else 0.0,
+                                    'ms_per_image': 1000 * stage['seconds'] / stage['images'] if stage['images'] > 0 else 0.0})
+        return stats
+
+    def cascadeReport(self):
+        stats = self.cascadeStats()
+        for n, stage in enumerate(stats['stages']):
+            print("Stage {}: {}.. Images: {}.. Accepted: {} ({:.1%}).. {:.1f} ms/image".format(
+                n+1, stage['checkpoint'], stage['images'], stage['accepted'], stage['hit_rate'], stage['ms_per_image']))
+        line = "Average cost: {:.1f} ms/image".format(stats['ms_per_image'])
+        if stats['stages'][-1]['images'] > 0:
+            line += ", the last stage alone: {:.1f} ms/image".format(stats['stages'][-1]['ms_per_image'])
+        print(line)
+
+    def runBatch(self):
+        paths = self.collectImages(self.in_arg.images)
+        print("Predicting "+str(len(paths))+" inputs in batches of "+str(self.in_arg.batch_size)+", writing to "+self.in_arg.output)
+        if self.in_arg.workers > 1 and self.device.type != 'cpu':
+            print("ERROR --workers forks CPU worker processes, it cannot be used with --gpu yes")
+            return
+        out = sys.stdout if self.in_arg.output == '-' else open(self.in_arg.output, 'w')
+        done, total = 0, 0
+        #One preallocated input buffer reused by every batch, each worker writes its own copy
+        self.buffer = self.preprocessor.buffer(self.in_arg.batch_size, pin_memory=self.device.type == 'cuda')
+        prepared = collections.deque()
+        tasks = self.prepareChunks(self.readImages(paths), prepared)
+        pool = None
+        if self.in_arg.workers > 1:
+            pool = workerpool.WorkerPool(self.workerChunk, self.in_arg.workers, self.in_arg.threads)
+            print("Started "+str(self.in_arg.workers)+" worker processes with "+str(pool.threads)+" thread(s) each")
+        try:
+            outputs = pool.map(tasks) if pool is not None else (self.inferChunk(*task) for task in tasks)
+            for output in outputs:
+                if pool is not None:
+                    output, counters = output
+                    for stage, (images, accepted, seconds) in zip(self.stages, counters):
+                        stage.update({'images': stage['images'] + images, 'accepted': stage['accepted'] + accepted,
+                                      'seconds': stage['seconds'] + seconds})
+                lines, keys = prepared.popleft()
+                results = iter(zip(keys, output))
+                for line in lines:
+                    if line is None:
+                        key, line = next(results)
+                        if key is not None and 'error' not in line:
+                            self.cache.put(key, line)
+                    total += 1
+                    if 'error' not in line:
+                        done += 1
+                    out.write(json.dumps(line)+"\n")
+                #Stream results as each batch completes
+                out.flush()
+        finally:
+            if pool is not None:
+                pool.close()
+            if out is not sys.stdout:
+                out.close()
+        print("Predicted "+str(done)+" of "+str(total)+" images")
+        if self.cache is not None:
+            print("Result cache: "+json.dumps(self.cache.stats()))
+        if len(self.stages) > 1:
+            self.cascadeReport()
+
+    def prepareChunks(self, images, prepared):
+        #Reads each batch and answers what it can from the result cache, yields the rest to run.
+        #The output lines, with None for results still to come, are appended to prepared in the same order
+        while True:
+            chunk = list(itertools.islice(images, self.in_arg.batch_size))
+            if len(chunk) == 0:
+                return
+            lines, keys, items = [], [], []
+            for path, reader in chunk:
+                try:
+                    data = reader()
+                except (IOError, OSError) as error:
+                    lines.append({'path': path, 'error': str(error)})
+                    continue
+                key = self.cache.key(data, self.in_arg.top_k) if self.cache is not None else None
+                cached = self.cache.get(key) if key is not None else None
+                if cached is not None:
+                    lines.append(dict(self.describe(cached['classes'], cached['probabilities']), path=path))
+                    continue
+                lines.append(None)
+                keys.append(key)
+                items.append((path, data))
+            prepared.append((lines, keys))
+            yield (items,)
+
+    def inferChunk(self, items):
+        #Decodes and predicts a list of (path, image bytes), one result or error per item
+        lines = [None] * len(items)
+        rows, pixels = [], []
+        for row, (path, data) in enumerate(items):
+            try:
+                pixels.append(self.preprocessor.crop(Image.open(io.BytesIO(data))))
+                rows.append(row)
+            except (IOError, OSError) as error:
+                lines[row] = {'path': path, 'error': str(error)}
+        if len(pixels) > 0:
+            results = self.predictBatch(self.preprocessor.batch(pixels, self.buffer), self.model, self.in_arg.top_k)
+            for row, (probs, classes) in zip(rows, results):
+                lines[row] = dict(self.describe(classes, probs), path=items[row][0])
+        return lines
+
+    def describe(self, classes, probs):
+        #One result record, names come from the current category file
+        return {'classes': classes,
+                'names': [ self.cat_to_name.get(c, c) for c in classes ],
+                'probabilities': [ float(p) for p in probs ]}
+
+    def workerChunk(self, items):
+        #Runs in a worker process, the cascade counters it adds are returned to the parent
+        before = [[stage['images'], stage['accepted'], stage['seconds']] for stage in self.stages]
+        lines = self.inferChunk(items)
+        counters = [[stage['images'] - images, stage['accepted'] - accepted, stage['seconds'] - seconds]
+                    for stage, (images, accepted, seconds) in zip(self.stages, before)]
+        return lines, counters
+
+    def readImages(self, paths):
+        #Yields (path, reader) pairs returning the encoded image bytes, tar shards are read front to back and their members named <shard>/<member>
+        for path in paths:
+            if path.endswith('.tar') and os.path.isfile(path):
+                for name, data, label in tarshards.readShard(path):
+                    yield path + '/' + name, lambda data=data: data
+            else:
+                yield path, lambda path=path: self.readFile(path)
+
+    def readFile(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def collectImages(self, sources):
+        #Expands directories, glob patterns and .txt file lists into image paths and tar shards
+        extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp', '.tar')
+        paths = []
+        for source in sources:
+            if os.path.isdir(source):
+                for root, dirs, files in os.walk(source):
+                    dirs.sort()
+                    paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(extensions))
+            elif source.endswith('.txt') and os.path.isfile(source):
+                with open(source, 'r') as f:
+                    paths.extend(line.strip() for line in f if line.strip() != '')
+            elif any(c in source for c in '*?['):
+                paths.extend(sorted(glob.glob(source, recursive=True)))
+            else:
+                paths.append(source)
+        return paths
+
     def process_image(self,image):
-        image.thumbnail([256,256],Image.ANTIALIAS)
-        width, height = image.size
-        #print(image.size)
-        leading = (width - 224)/2
-        if leading <= 0:
-            leading = 0
-            trailing = 224
-        else:
-            trailing = leading + 224
-            
-        top = (height - 224)/2
-        if top <= 0:
-            top = 0
-            bottom = 224
-        else:
-            bottom = top + 224
-        
-        #print("Leading: "+str(leading)+" Top: "+str(top)+" Trailing: "+str(trailing)+" Bottom: "+str(bottom))
-        image = image.crop(box=(leading,top,trailing,bottom))
-        np_image = np.array(image)/255
-        
-        np_mean = np.array(self.mean)
-        np_sd = np.array(self.sd)
-        
-        np_image = ((np_image-np_mean)/np_sd)
-        np_image = np_image.transpose((2,0,1))
-        return torch.from_numpy(np_image)
+        return self.preprocessor.process(image)
 
     def loadCheckPoint(self):
-        checkpoint = torch.load(self.in_arg.checkpoint, map_location=lambda storage, loc: storage)
-        #checkpoint = torch.load(name+'.pth')
-        classifier = myhelper.Network(checkpoint['input_size'], checkpoint['output_size'], checkpoint['hidden_layers'], drop_p=checkpoint['drop'])
-        classifier.load_state_dict(checkpoint['state_dict'])
-        
-        print("Loading model "+str(checkpoint['model']))
-        if checkpoint['model'] == 'vgg16':
-            self.model = models.vgg16(pretrained = True)
-        elif checkpoint['model'] == 'densenet161':
-            self.model = models.densenet161(pretrained = True)
-            
-        for params in self.model.parameters():
-            params.requires_grad = False
-
-        self.model.classifier = classifier
-        self.model.to(self.device)
-
-        return {'input_size': checkpoint['input_size'],
-                'output_size': checkpoint['output_size'],
-                'batch_size': checkpoint['batch_size'],
-                'epochs': checkpoint['epochs'],
-                'drop': checkpoint['drop'],
-                'model': checkpoint['model'],
-                'learning_rate': checkpoint['learning_rate'],
-                'class_to_idx': checkpoint['class_to_idx'],
-                'hidden_layers': checkpoint['hidden_layers']}
-
-    def get_input_args(self):
+        self.model, checkpoint = myhelper.loadCheckpoint(self.in_arg.checkpoint, self.device)
+        self.device = checkpoint['device']
+        #Defaults to the precision the checkpoint was trained with, int8 and traced models run as exported
+        self.precision = self.in_arg.precision or checkpoint.get('precision', 'fp32')
+        traced = 'mean' in checkpoint or self.in_arg.compile == 'script'
+        if self.precision != 'fp32' and (checkpoint.get('format') == 'int8' or traced):
+            print("Precision "+self.precision+" does not apply to this checkpoint, using fp32")
+            self.precision = 'fp32'
+        print("Using precision "+self.precision)
+        #Exported artifacts carry their own preprocessing constants
+        if 'mean' in checkpoint:
+            self.preprocessor = preprocess.Preprocessor(checkpoint['size'], checkpoint['resize'], checkpoint['mean'], checkpoint['sd'], self.in_arg.draft)
+        self.memory_format = torch.contiguous_format
+        if self.in_arg.compile != 'none' and 'mean' not in checkpoint:
+            print("Compiling model with "+self.in_arg.compile)
+            self.model.eval()
+            example = torch.zeros(1, 3, self.preprocessor.size, self.preprocessor.size)
+            key = myhelper.fingerprint(self.in_arg.checkpoint, self.device, torch.__version__)
+            self.model = myhelper.optimize(self.model, self.in_arg.compile, self.device, example, self.in_arg.compile_cache, key)
+            self.memory_format = torch.channels_last
+        return checkpoint
+
+    def loadStages(self):
+        #The --checkpoint model is the first stage, --cascade adds more expensive ones after it
+        stages = [{'path': self.in_arg.checkpoint, 'model': self.model.eval(), 'device': self.device,
+                   'precision': self.precision, 'memory_format': self.memory_format}]
+        for path in self.in_arg.cascade or []:
+            model, checkpoint = myhelper.loadCheckpoint(path, myhelper.device(self.in_arg.gpu))
+            if checkpoint['class_to_idx'] != self.checkpoint['class_to_idx']:
+                print("ERROR Cascade checkpoint "+path+" was trained on different classes")
+                return None
+            precision = self.in_arg.precision or checkpoint.get('precision', 'fp32')
+            if checkpoint.get('format') == 'int8' or 'mean' in checkpoint:
+                precision = 'fp32'
+            stages.append({'path': path, 'model': model.eval(), 'device': checkpoint['device'],
+                           'precision': precision, 'memory_format': torch.contiguous_format})
+        for stage in stages:
+            stage.update({'images': 0, 'accepted': 0, 'seconds': 0.0})
+        if len(stages) > 1:
+            print("Cascade of "+str(len(stages))+" stages, accepting at top-1 probability "+str(self.in_arg.threshold)+" and margin "+str(self.in_arg.margin))
+        return stages
+
+    def get_input_args(self, args=None):
         parser = argparse.ArgumentParser()
         parser.add_argument('--checkpoint',type=str, help='<Required>Set path to checkpoint', required=True)
-        parser.add_argument('--image',type=str, help='<Required> Set path to image', required=True)
+        parser.add_argument('--cascade',type=str, nargs='+', help='Set more expensive checkpoints tried in order when --checkpoint is not confident')
+        parser.add_argument('--threshold',type=float,default=0.8, help='Set top-1 probability a cascade stage needs to accept an image, default 0.8')
+        parser.add_argument('--margin',type=float,default=0.0, help='Set top-1 minus top-2 probability a cascade stage needs to accept an image, default 0')
+        parser.add_argument('--image',type=str, help='Set path to image')
+        parser.add_argument('--images',type=str, nargs='+', help='Set directories, glob patterns, .txt file lists, image paths or tar shards to predict in batches')
+        parser.add_argument('--batch_size',type=int,default=32, help='Set batch size for --images, default 32')
+        parser.add_argument('--workers',type=int,default=1, help='Set number of forked CPU worker processes sharing the loaded model for --images, default 1 (in process)')
+        parser.add_argument('--threads',type=int, help='Set intra-op threads per worker process, default cores divided by --workers')
+        parser.add_argument('--output',type=str,default='predictions.jsonl', help='Set JSON Lines output file for --images, "-" for stdout, default predictions.jsonl')
+        parser.add_argument('--serve',action='store_true', help='Keep the model loaded and serve predictions over HTTP')
+        parser.add_argument('--host',type=str,default='127.0.0.1', help='Set host for --serve, default 127.0.0.1')
+        parser.add_argument('--port',type=int,default=8000, help='Set port for --serve, default 8000')
+        parser.add_argument('--socket',type=str, help='Set a unix socket path for --serve instead of host and port')
+        parser.add_argument('--max_batch_size',type=int,default=32, help='Set largest micro-batch for --serve, default 32')
+        parser.add_argument('--max_delay',type=float,default=5.0, help='Set milliseconds a request may wait for a micro-batch to fill, default 5')
+        parser.add_argument('--cache',type=int,default=0, help='Set number of results kept in memory for repeated images, default 0 (off)')
+        parser.add_argument('--cache_db',type=str, help='Set SQLite file that keeps cached results across runs, cleared when the checkpoint changes')
+        parser.add_argument('--draft',type=int,help='Decode JPEGs at a reduced scale keeping the short side at least this many pixels, eg. 256')
+        parser.add_argument('--precision',type=str,choices=['fp32','bf16','fp16'], help='Set autocast precision, default the precision the checkpoint was trained with')
+        parser.add_argument('--compile',type=str,default='none',choices=['none','inductor','script'], help='Set graph compilation: torch.compile with inductor or a frozen TorchScript trace, with channels_last inputs, default none')
+        parser.add_argument('--compile_cache',type=str,default='.compile_cache', help='Set directory for compiled models and kernels reused across runs, default .compile_cache')
         parser.add_argument('--top_k',type=int,default=1, help='Set the number of top predictions wanted, default 1')
         parser.add_argument('--category_names',type=str,default='cat_to_name.json', help='Path to category names file, default cat_to_name.json')
         parser.add_argument('--gpu',type=str, default="no", help='Set yes to use GPU, default CPU')
-        return parser.parse_args() 
+        return parser.parse_args(args)
 
-Predict()
\ No newline at end of file
+if __name__ == '__main__':
+    Predict()
@@ -0,0 +1,146 @@
+import asyncio
+import collections
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from PIL import Image
+import myhelper
+import preprocess
+import resultcache
+
+
+class Predictor:
+    #In-process prediction from a checkpoint, for use as a library instead of running predict.py.
+    #Images are decoded and cropped on a thread pool while the model runs on the previous batch
+    def __init__(self, checkpoint, gpu='no', top_k=1, batch_size=32, workers=4, prefetch=2,
+                 precision=None, draft=None, category_names=None, cache_size=0, cache_path=None):
+        self.device = myhelper.device(gpu)
+        if self.device is None:
+            raise RuntimeError("GPU requested but not available")
+        self.model, self.checkpoint = myhelper.loadCheckpoint(checkpoint, self.device)
+        self.device = self.checkpoint['device']
+        self.model.eval()
+        self.top_k = top_k
+        self.batch_size = batch_size
+        #Decoded images waiting for the model are bounded to this many batches
+        self.prefetch = prefetch
+        self.precision = precision or self.checkpoint.get('precision', 'fp32')
+        if self.checkpoint.get('format') == 'int8' or 'mean' in self.checkpoint:
+            self.precision = 'fp32'
+        if 'mean' in self.checkpoint:
+            self.preprocessor = preprocess.Preprocessor(self.checkpoint['size'], self.checkpoint['resize'],
+                                                        self.checkpoint['mean'], self.checkpoint['sd'], draft)
+        else:
+            self.preprocessor = preprocess.Preprocessor(draft=draft)
+        self.idx_to_class = {i: c for c, i in self.checkpoint['class_to_idx'].items()}
+        self.cat_to_name = None
+        if category_names is not None:
+            with open(category_names, 'r') as f:
+                self.cat_to_name = json.load(f)
+        self.cache = None
+        if cache_size > 0 or cache_path is not None:
+            fingerprint = resultcache.fingerprint([checkpoint], [self.precision], draft=draft)
+            self.cache = resultcache.ResultCache(fingerprint, max(cache_size, 1), cache_path)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        #Async callers run concurrently, their decoding overlaps and only forward waits for the lock
+        self.runner = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown()
+        self.runner.shutdown()
+        if self.cache is not None:
+            self.cache.close()
+
+    def decode(self, image, top_k):
+        #Accepts a path, raw bytes, a file object or a PIL image.
+        #Returns (cache key, cached result, cropped pixels), PIL images are never cached
+        if isinstance(image, Image.Image):
+            return None, None, self.preprocessor.crop(image)
+        if isinstance(image, (str, os.PathLike)):
+            with open(image, 'rb') as f:
+                data = f.read()
+        elif isinstance(image, (bytes, bytearray)):
+            data = bytes(image)
+        else:
+            data = image.read()
+        key, cached = None, None
+        if self.cache is not None:
+            key = self.cache.key(data, top_k)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return key, self.describe(cached['classes'], cached['probabilities']), None
+        return key, None, self.preprocessor.crop(preprocess.openImage(io.BytesIO(data)))
+
+    def forward(self, pixels, top_k):
+        batch = self.preprocessor.batch(pixels)
+        #One model call at a time, callers on other threads wait here
+        with self.lock, torch.no_grad(), myhelper.autocast(self.device, self.precision):
+            output = self.model.forward(batch.to(self.device)).float()
+            probs, indices = torch.topk(torch.exp(output), top_k)
+        probs, indices = probs.cpu().numpy(), indices.cpu().numpy()
+        results = []
+        for row in range(len(indices)):
+            results.append(self.describe([self.idx_to_class[i] for i in indices[row]], probs[row]))
+        return results
+
+    def describe(self, classes, probs):
+        #Same fields as predict.py, class labels stand in for names without a category file
+        names = [self.cat_to_name.get(c, c) for c in classes] if self.cat_to_name is not None else classes
+        return {'classes': classes, 'names': names, 'probabilities': [float(p) for p in probs]}
+
+    def map(self, images, top_k=None):
+        #Yields one result per image in input order, unreadable images give {'error': ...}
+        top_k = top_k or self.top_k
+        iterator = iter(images)
+        pending = collections.deque()
+
+        def fill():
+            while len(pending) < self.batch_size * self.prefetch:
+                image = next(iterator, fill)
+                if image is fill:
+                    return
+                pending.append(self.pool.submit(self.decode, image, top_k))
+
+        fill()
+        while len(pending) > 0:
+            futures = [pending.popleft() for i in range(min(self.batch_size, len(pending)))]
+            #Queue the next decodes before running the model on this batch
+            fill()
+            decoded = []
+            for future in futures:
+                try:
+                    decoded.append(future.result())
+                except (IOError, OSError) as error:
+                    decoded.append(error)
+            pixels = [item[2] for item in decoded if not isinstance(item, Exception) and item[1] is None]
+            results = iter(self.forward(pixels, top_k) if len(pixels) > 0 else [])
+            for item in decoded:
+                if isinstance(item, Exception):
+                    yield {'error': str(item)}
+                    continue
+                key, result, unused = item
+                if result is None:
+                    result = next(results)
+                    if key is not None:
+                        self.cache.put(key, result)
+                yield result
+
+    def predict(self, images, top_k=None):
+        return list(self.map(images, top_k))
+
+    def stats(self):
+        return self.cache.stats() if self.cache is not None else {}
+
+    async def predict_async(self, images, top_k=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.runner, self.predict, images, top_k)
@@ -0,0 +1,143 @@
+import argparse
+import glob
+import sys
+import time
+import numpy as np
+import torch
+from torchvision import transforms
+from PIL import Image
+
+mean = [0.485, 0.456, 0.406]
+sd = [0.229, 0.224, 0.225]
+
+
+def openImage(source, short_side=None):
+    #With short_side, JPEGs are decoded at the smallest DCT scale (1/2, 1/4 or 1/8) that keeps both sides at least that long
+    image = Image.open(source)
+    if short_side is not None:
+        image.draft('RGB', (short_side, short_side))
+    return image
+
+
+def loadImage(path, short_side=None):
+    #ImageFolder loader, use functools.partial(loadImage, short_side=...) for reduced decoding
+    with open(path, 'rb') as f:
+        return openImage(f, short_side).convert('RGB')
+
+
+class Preprocessor:
+    #Resizes and crops like Predict.process_image, then normalizes uint8 pixels straight into float32 CHW.
+    #With draft, images not yet decoded are decoded at a reduced scale keeping the short side at least draft pixels
+    def __init__(self, size=224, resize=256, mean=mean, sd=sd, draft=None):
+        self.size = size
+        self.resize = resize
+        self.draft = draft
+        #(pixel/255 - mean)/sd folded into a single multiply-add per channel
+        self.scale = (1.0 / (255.0 * np.array(sd))).astype(np.float32).reshape(1, 3, 1, 1)
+        self.bias = (-np.array(mean) / np.array(sd)).astype(np.float32).reshape(1, 3, 1, 1)
+
+    def crop(self, image):
+        if self.draft is not None:
+            #Never below the resize, a smaller decode would leave the crop short and pad it with black
+            target = max(self.draft, self.resize)
+            image.draft('RGB', (target, target))
+        #thumbnail resizes in place, so the caller's image is copied rather than changed
+        image = image.convert('RGB') if image.mode != 'RGB' else image.copy()
+        image.thumbnail([self.resize, self.resize], Image.LANCZOS)
+        width, height = image.size
+        leading = max((width - self.size)/2, 0)
+        top = max((height - self.size)/2, 0)
+        image = image.crop(box=(leading, top, leading + self.size, top + self.size))
+        return np.asarray(image, dtype=np.uint8)
+
+    def buffer(self, count, pin_memory=False):
+        return torch.empty((count, 3, self.size, self.size), dtype=torch.float32, pin_memory=pin_memory)
+
+    def batch(self, images, out=None):
+        #Accepts PIL images or uint8 HWC arrays from crop(), writes into out when given
+        pixels = np.stack([image if isinstance(image, np.ndarray) else self.crop(image) for image in images])
+        if out is None:
+            out = self.buffer(len(pixels))
+        out = out[:len(pixels)]
+        target = out.numpy()
+        np.multiply(pixels.transpose((0, 3, 1, 2)), self.scale, out=target, dtype=np.float32)
+        target += self.bias
+        return out
+
+    def process(self, image):
+        return self.batch([image])[0]
+
+
+def referenceProcess(image, size=224, resize=256, mean=mean, sd=sd):
+    #The original float64 Predict.process_image maths, kept to check Preprocessor against
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail([resize, resize], Image.LANCZOS)
+    width, height = image.size
+    leading = max((width - size)/2, 0)
+    top = max((height - size)/2, 0)
+    image = image.crop(box=(leading, top, leading + size, top + size))
+    np_image = np.array(image)/255
+    np_image = (np_image - np.array(mean))/np.array(sd)
+    return torch.from_numpy(np_image.transpose((2, 0, 1)))
+
+
+def checkParity(paths, size=224, resize=256, tolerance=1e-5):
+    #Largest difference between the float32 batched path and the original maths, True when within tolerance
+    preprocessor = Preprocessor(size, resize)
+    largest = 0.0
+    for path in paths:
+        expected = referenceProcess(Image.open(path), size, resize)
+        actual = preprocessor.batch([Image.open(path)])[0].double()
+        largest = max(largest, (expected - actual).abs().max().item())
+    print("Parity with process_image: Max abs difference: {:.2e}.. Tolerance: {:.0e}.. {}".format(
+        largest, tolerance, "OK" if largest <= tolerance else "FAILED"))
+    return largest <= tolerance
+
+
+def evalTransforms(size=224, resize=256):
+    #Same as the validation and test transforms in train.py
+    return transforms.Compose([transforms.Resize(resize),
+                               transforms.CenterCrop(size),
+                               transforms.ToTensor(),
+                               transforms.Normalize(mean, sd)])
+
+
+def compareDraft(paths, size=224, resize=256):
+    #Times full and reduced decoding on both preprocessing paths and reports the pixel difference of the normalized tensors
+    paths = list(paths)
+    transform = evalTransforms(size, resize)
+    pipelines = {'predict': (lambda path, short_side: Preprocessor(size, resize, draft=short_side).process(Image.open(path))),
+                     'train': (lambda path, short_side: transform(loadImage(path, short_side)))}
+    for name, run in pipelines.items():
+        seconds = {'full': 0.0, 'draft': 0.0}
+        largest, total = 0.0, 0.0
+        for path in paths:
+            start = time.perf_counter()
+            full = run(path, None)
+            seconds['full'] += time.perf_counter() - start
+            start = time.perf_counter()
+            reduced = run(path, resize)
+            seconds['draft'] += time.perf_counter() - start
+            difference = (full - reduced).abs()
+            largest = max(largest, difference.max().item())
+            total += difference.mean().item()
+        print("{}: Full: {:.2f} ms/image.. Draft: {:.2f} ms/image.. Speed-up: {:.2f}x.. Mean abs difference: {:.4f}.. Max abs difference: {:.4f}".format(
+            name, 1000 * seconds['full'] / len(paths), 1000 * seconds['draft'] / len(paths),
+            seconds['full'] / max(seconds['draft'], 1e-9), total / len(paths), largest))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images',type=str,default='flowers/valid/*/*.jpg', help='Set glob pattern of images to compare on, default flowers/valid/*/*.jpg')
+    parser.add_argument('--limit',type=int,default=200, help='Set largest number of images to compare, default 200')
+    in_arg = parser.parse_args()
+    paths = sorted(glob.glob(in_arg.images, recursive=True))[:in_arg.limit]
+    if len(paths) == 0:
+        print("ERROR No images match "+in_arg.images)
+    else:
+        print("Checking batched preprocessing on "+str(len(paths))+" images")
+        if not checkParity(paths):
+            sys.exit(1)
+        print("Comparing full and draft decoding on "+str(len(paths))+" images")
+        compareDraft(paths)
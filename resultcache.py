@@ -0,0 +1,81 @@
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import myhelper
+
+
+def fingerprint(checkpoints, precisions, threshold=None, margin=None, draft=None, compile='none'):
+    #Everything that changes a result: the checkpoint files and the settings they run with.
+    #predict.py and Predictor share it so they can share one cache file
+    extra = [myhelper.fingerprint(path) for path in checkpoints[1:]]
+    #The acceptance thresholds only matter in a cascade
+    if len(checkpoints) > 1:
+        extra += [threshold, margin]
+    return myhelper.fingerprint(checkpoints[0], *extra, *precisions, draft, compile)
+
+
+class ResultCache:
+    #Prediction results keyed on the image bytes, the checkpoint fingerprint and top_k.
+    #A bounded in-memory LRU sits in front of an optional SQLite file shared between runs
+    def __init__(self, fingerprint, capacity=10000, path=None):
+        self.fingerprint = fingerprint
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, fingerprint TEXT, result TEXT)')
+            #Results of any other checkpoint can never be hit again
+            self.db.execute('DELETE FROM results WHERE fingerprint != ?', (fingerprint,))
+            self.db.commit()
+
+    def key(self, data, top_k):
+        return hashlib.sha256(data).hexdigest() + ':' + self.fingerprint + ':' + str(top_k)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counts['memory_hits'] += 1
+                return dict(self.entries[key])
+            if self.db is not None:
+                row = self.db.execute('SELECT result FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self.counts['disk_hits'] += 1
+                    result = json.loads(row[0])
+                    self.remember(key, result)
+                    return dict(result)
+            self.counts['misses'] += 1
+            return None
+
+    def put(self, key, result):
+        #Names are left out, readers look them up in their own category file
+        result = {'classes': result['classes'], 'probabilities': result['probabilities']}
+        with self.lock:
+            self.remember(key, result)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', (key, self.fingerprint, json.dumps(result)))
+                self.db.commit()
+
+    def remember(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.counts['evictions'] += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = sum(self.counts[name] for name in ['memory_hits', 'disk_hits', 'misses'])
+            stats = dict(self.counts, entries=len(self.entries))
+            stats['hit_rate'] = (self.counts['memory_hits'] + self.counts['disk_hits']) / lookups if lookups > 0 else 0.0
+            return stats
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,197 @@
+import io
+import json
+import os
+import queue
+import threading
+import time
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        with self.lock:
+            index = 0
+            while index < len(self.bounds) and value > self.bounds[index]:
+                index += 1
+            self.counts[index] += 1
+            self.total += 1
+            self.sum += value
+
+    def report(self):
+        with self.lock:
+            buckets = {('<=' + str(b)): c for b, c in zip(self.bounds, self.counts)}
+            buckets['>' + str(self.bounds[-1])] = self.counts[-1]
+            mean = self.sum / self.total if self.total > 0 else 0.0
+            return {'count': self.total, 'mean': mean, 'buckets': buckets}
+
+
+class PendingRequest:
+    def __init__(self, image, topk):
+        self.image = image
+        self.topk = topk
+        self.arrived = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class PredictServer:
+    #Keeps one loaded model resident and merges concurrent requests into micro-batches
+    def __init__(self, predictor, max_batch_size=32, max_delay=5.0):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay / 1000.0
+        self.pending = queue.Queue()
+        self.buffer = predictor.preprocessor.buffer(max_batch_size)
+        self.latency = Histogram([1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000])
+        self.batch_sizes = Histogram([1, 2, 4, 8, 16, 32, 64, 128, 256])
+        self.worker = threading.Thread(target=self.runBatches, daemon=True)
+        self.worker.start()
+
+    def submit(self, data, topk):
+        #Takes encoded image bytes, repeated images are answered from the result cache
+        arrived = time.perf_counter()
+        cache = self.predictor.cache
+        key = cache.key(data, topk) if cache is not None else None
+        cached = cache.get(key) if key is not None else None
+        if cached is not None:
+            latency = (time.perf_counter() - arrived) * 1000
+            self.latency.add(latency)
+            return dict(self.predictor.describe(cached['classes'], cached['probabilities']), cached=True, latency_ms=latency)
+        request = PendingRequest(self.predictor.preprocessor.crop(Image.open(io.BytesIO(data))), topk)
+        self.pending.put(request)
+        request.done.wait()
+        latency = (time.perf_counter() - arrived) * 1000
+        self.latency.add(latency)
+        if request.error is not None:
+            raise request.error
+        if key is not None:
+            cache.put(key, request.result)
+        request.result['latency_ms'] = latency
+        return request.result
+
+    def nextBatch(self):
+        batch = [self.pending.get()]
+        deadline = batch[0].arrived + self.max_delay
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                #Past the deadline, still take whatever queued up during the last forward pass
+                if remaining <= 0:
+                    batch.append(self.pending.get_nowait())
+                else:
+                    batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def runBatches(self):
+        while True:
+            batch = self.nextBatch()
+            self.batch_sizes.add(len(batch))
+            topk = max(request.topk for request in batch)
+            try:
+                images = self.predictor.preprocessor.batch([request.image for request in batch], self.buffer)
+                results = self.predictor.predictBatch(images, self.predictor.model, topk)
+                for request, (probs, classes) in zip(batch, results):
+                    classes = classes[:request.topk]
+                    request.result = dict(self.predictor.describe(classes, probs[:request.topk]), batch_size=len(batch))
+            except Exception as error:
+                for request in batch:
+                    request.error = error
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        stats = {'latency_ms': self.latency.report(), 'batch_size': self.batch_sizes.report()}
+        if self.predictor.cache is not None:
+            stats['cache'] = self.predictor.cache.stats()
+        if len(self.predictor.stages) > 1:
+            stats['cascade'] = self.predictor.cascadeStats()
+        return stats
+
+    def makeHandler(self):
+        server = self
+        default_topk = self.predictor.in_arg.top_k
+        num_classes = len(self.predictor.checkpoint['class_to_idx'])
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def sendJson(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if urlparse(self.path).path == '/stats':
+                    self.sendJson(200, server.stats())
+                else:
+                    self.sendJson(404, {'error': 'not found'})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != '/predict':
+                    self.sendJson(404, {'error': 'not found'})
+                    return
+                query = parse_qs(url.query)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                #A bad top_k is refused here, in a merged micro-batch it would fail every other request too
+                try:
+                    topk = int(query.get('top_k', [default_topk])[0])
+                except ValueError:
+                    topk = 0
+                if topk < 1 or topk > num_classes:
+                    self.sendJson(400, {'error': 'top_k must be between 1 and '+str(num_classes)})
+                    return
+                try:
+                    #Either raw image bytes or {"path": ...} for images on the server host
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        with open(json.loads(body.decode('utf-8'))['path'], 'rb') as f:
+                            body = f.read()
+                    result = server.submit(body, topk)
+                except (IOError, OSError, KeyError, ValueError) as error:
+                    self.sendJson(400, {'error': str(error)})
+                    return
+                except Exception as error:
+                    self.sendJson(500, {'error': str(error)})
+                    return
+                self.sendJson(200, result)
+
+        return Handler
+
+    def serve(self, host='127.0.0.1', port=8000, socket_path=None):
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+            class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+                daemon_threads = True
+
+            httpd = UnixHTTPServer(socket_path, self.makeHandler())
+            print("Serving on unix socket "+socket_path)
+        else:
+            httpd = ThreadingHTTPServer((host, port), self.makeHandler())
+            print("Serving on http://"+host+":"+str(port))
+        print("POST images to /predict, GET /stats for latency and batch size histograms")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("Stopping server")
+        finally:
+            httpd.server_close()
+            print(json.dumps(self.stats()))
@@ -0,0 +1,108 @@
+import glob
+import os
+import random
+import threading
+import numpy as np
+import torch
+
+
+def copyToCpu(value):
+    #Detached CPU copies so training can keep updating the originals while the copy is written
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: copyToCpu(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(copyToCpu(item) for item in value)
+    return value
+
+
+def rngState():
+    #Kept to plain types and tensors so the file also loads with torch.load(weights_only=True)
+    numpy_state = np.random.get_state()
+    state = {'torch': torch.get_rng_state(),
+             'numpy': [numpy_state[0], numpy_state[1].tolist(), numpy_state[2], numpy_state[3], numpy_state[4]],
+             'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def setRngState(state):
+    torch.set_rng_state(state['torch'])
+    numpy_state = state['numpy']
+    np.random.set_state((numpy_state[0], np.array(numpy_state[1], dtype=np.uint32), numpy_state[2], numpy_state[3], numpy_state[4]))
+    random.setstate((state['python'][0], tuple(state['python'][1]), state['python'][2]))
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    #Shuffles with a per-epoch seed so an epoch's order can be rebuilt and entered part way through.
+    #With several replicas each rank takes every num_replicas-th index, padded like DistributedSampler
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.total = len(data_source)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.count = -(-self.total // num_replicas)
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def setEpoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.total, generator=generator).tolist()
+        order += order[:self.count * self.num_replicas - self.total]
+        return iter(order[self.rank::self.num_replicas][self.start:])
+
+    def __len__(self):
+        return max(self.count - self.start, 0)
+
+
+class AsyncCheckpointer:
+    #Writes snapshots on a background thread with atomic renames, keeping the newest few
+    def __init__(self, directory, prefix='resume_', keep=3):
+        self.directory = directory
+        self.prefix = prefix
+        self.keep = keep
+        self.thread = None
+        self.error = None
+
+    def save(self, state, path=None, step=0):
+        #At most one write in flight, a new snapshot waits for the previous one
+        self.wait()
+        snapshot = copyToCpu(state)
+        if path is None:
+            path = os.path.join(self.directory, self.prefix + '{:09d}.pth'.format(step))
+        self.thread = threading.Thread(target=self.write, args=(snapshot, path, path.startswith(os.path.join(self.directory, self.prefix))))
+        self.thread.start()
+
+    def write(self, snapshot, path, prune):
+        try:
+            torch.save(snapshot, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            if prune:
+                for old in self.list()[:-self.keep]:
+                    os.remove(old)
+        except Exception as error:
+            self.error = error
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def list(self):
+        return sorted(glob.glob(os.path.join(self.directory, self.prefix + '*.pth')))
+
+    def latest(self):
+        snapshots = self.list()
+        return snapshots[-1] if len(snapshots) > 0 else None
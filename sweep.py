@@ -0,0 +1,77 @@
+import itertools
+import torch
+from torch import optim
+import metrics
+import myhelper
+
+
+def configs(hidden_units, learning_rates, drops):
+    #Every combination of the swept values
+    return [{'hidden_layers': hidden, 'learning_rate': rate, 'drop': drop}
+            for hidden, rate, drop in itertools.product(hidden_units, learning_rates, drops)]
+
+
+class HeadSweep:
+    #Several classifier heads trained side by side, the frozen backbone runs once per batch for all of them
+    def __init__(self, configs, input_size, output_size, device, precision='fp32', backbone=None):
+        self.configs = configs
+        self.device = device
+        self.precision = precision
+        self.backbone = backbone
+        self.heads = [myhelper.Network(input_size, output_size, config['hidden_layers'], drop_p=config['drop']).to(device)
+                      for config in configs]
+        self.optimizers = [optim.Adam(head.parameters(), lr=config['learning_rate']) for head, config in zip(self.heads, configs)]
+        self.scalers = [myhelper.gradScaler(device, precision) for head in self.heads]
+        self.metrics = [metrics.Metrics(device) for head in self.heads]
+        self.resetLoss()
+
+    def resetLoss(self):
+        #Training losses stay on the device until they are reported
+        self.running_loss = torch.zeros(len(self.heads), device=self.device)
+        self.steps = 0
+
+    def features(self, images):
+        #Loaders over cached features already yield backbone outputs
+        if self.backbone is None:
+            return images
+        with torch.no_grad(), myhelper.autocast(self.device, self.precision):
+            return self.backbone.forward(images)
+
+    def step(self, images, labels, criterion):
+        features = self.features(images)
+        losses = []
+        for head, optimizer, scaler in zip(self.heads, self.optimizers, self.scalers):
+            head.train()
+            optimizer.zero_grad()
+            with myhelper.autocast(self.device, self.precision):
+                loss = criterion(head.forward(features), labels)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            losses.append(loss.detach().float())
+        self.running_loss += torch.stack(losses)
+        self.steps += 1
+
+    def trainingLoss(self):
+        losses = (self.running_loss / max(self.steps, 1)).tolist()
+        self.resetLoss()
+        return losses
+
+    def validate(self, loader, criterion, memory_format=torch.contiguous_format):
+        #Returns (loss, accuracy) per head, in the order of the configs
+        for head, tracker in zip(self.heads, self.metrics):
+            head.eval()
+            tracker.reset()
+        with torch.no_grad(), myhelper.autocast(self.device, self.precision):
+            for images, labels in loader:
+                images = images.to(self.device, non_blocking=True, memory_format=memory_format)
+                labels = labels.to(self.device, non_blocking=True)
+                features = self.features(images)
+                for head, tracker in zip(self.heads, self.metrics):
+                    output = head.forward(features)
+                    tracker.update(output, labels, criterion(output, labels))
+        return [tracker.compute() for tracker in self.metrics]
+
+    def ranking(self, results):
+        #Head indices, best validation accuracy first, lower loss breaking ties
+        return sorted(range(len(self.heads)), key=lambda i: (-results[i][1], results[i][0]))
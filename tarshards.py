@@ -0,0 +1,233 @@
+import argparse
+import io
+import json
+import math
+import os
+import random
+import tarfile
+import torch
+from torchvision import datasets
+import myhelper
+import preprocess
+
+
+def isCurrent(shard_dir, split, split_dir, shard_mb, seed=0):
+    #The shards must come from the same images of the same folder, packed with the same size and order
+    meta_path = os.path.join(shard_dir, split + '.json')
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    return (meta.get('shard_mb') == shard_mb and meta.get('seed') == seed
+            and meta.get('source') == myhelper.folderSource(split_dir, datasets.ImageFolder(split_dir).samples))
+
+
+def addMember(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def packShards(split_dir, shard_dir, split, shard_mb=256, seed=0):
+    #Packs the original image bytes and labels of an ImageFolder split into tar shards read front to back.
+    #Samples are written in a shuffled order so a shard holds a mix of classes
+    folder = datasets.ImageFolder(split_dir)
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    meta_path = os.path.join(shard_dir, split + '.json')
+    if os.path.isfile(meta_path):
+        os.remove(meta_path)
+    print("Packing "+str(len(folder.samples))+" images from "+split_dir+" into "+str(shard_mb)+" MB shards")
+
+    samples = list(folder.samples)
+    random.Random(seed).shuffle(samples)
+    shard_bytes = shard_mb * 1024 * 1024
+    shards = []
+    tar, size = None, 0
+    try:
+        for i, (path, label) in enumerate(samples):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if tar is None or (size > 0 and size + len(data) > shard_bytes):
+                if tar is not None:
+                    tar.close()
+                shards.append({'name': split + '-{:05d}.tar'.format(len(shards)), 'count': 0})
+                tar, size = tarfile.open(os.path.join(shard_dir, shards[-1]['name']), 'w'), 0
+            key = '{:08d}'.format(i)
+            addMember(tar, key + os.path.splitext(path)[1].lower(), data)
+            addMember(tar, key + '.cls', str(label).encode('utf-8'))
+            shards[-1]['count'] += 1
+            size += len(data)
+    finally:
+        if tar is not None:
+            tar.close()
+    meta = {'shards': shards,
+            'source': myhelper.folderSource(split_dir, folder.samples),
+            'shard_mb': shard_mb,
+            'seed': seed,
+            'count': len(samples),
+            'classes': folder.classes,
+            'class_to_idx': folder.class_to_idx}
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    print("Wrote "+str(len(shards))+" shard(s) to "+shard_dir)
+
+
+def readShard(path):
+    #Yields (name, image bytes, label) in the order the members were written, label is None without .cls members
+    with tarfile.open(path, 'r|') as tar:
+        key, name, data, label = None, None, None, None
+        for member in tar:
+            if not member.isfile():
+                continue
+            stem, extension = os.path.splitext(member.name)
+            if stem != key:
+                if data is not None:
+                    yield name, data, label
+                key, name, data, label = stem, None, None, None
+            content = tar.extractfile(member).read()
+            if extension == '.cls':
+                label = int(content.decode('utf-8'))
+            else:
+                name, data = member.name, content
+        if data is not None:
+            yield name, data, label
+
+
+class TarShardDataset(torch.utils.data.IterableDataset):
+    #Streams packShards output sequentially, shuffling the shard order and within a bounded buffer.
+    #Shards are divided between data loader workers, or samples when there are several ranks or too few shards
+    def __init__(self, shard_dir, split, transform=None, shuffle=False, buffer_size=1000, seed=0, draft=None):
+        with open(os.path.join(shard_dir, split + '.json'), 'r') as f:
+            meta = json.load(f)
+        self.shard_dir = shard_dir
+        self.transform = transform
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.draft = draft
+        self.shards = [os.path.join(shard_dir, shard['name']) for shard in meta['shards']]
+        self.sizes = {os.path.join(shard_dir, shard['name']): shard['count'] for shard in meta['shards']}
+        self.count = meta['count']
+        self.classes = meta['classes']
+        self.class_to_idx = meta['class_to_idx']
+        self.num_replicas = 1
+        self.rank = 0
+        #Set by the data loader, workers hand out whole batches in turn
+        self.batch_size = 1
+        self.epoch = 0
+        self.start = 0
+
+    def setEpoch(self, epoch, start=0):
+        #start skips samples already seen by this rank, like snapshot.ResumableSampler
+        self.epoch = epoch
+        self.start = start
+
+    def __len__(self):
+        return math.ceil(self.count / self.num_replicas)
+
+    def shardOrder(self):
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards
+
+    def workerCounts(self, workers):
+        #Samples each data loader worker of this rank yields in the epoch
+        if self.num_replicas > 1:
+            per_rank = len(self)
+            return [per_rank // workers + (1 if worker < per_rank % workers else 0) for worker in range(workers)]
+        shards = self.shardOrder()
+        if len(shards) >= workers:
+            return [sum(self.sizes[path] for path in shards[worker::workers]) for worker in range(workers)]
+        return [self.count // workers + (1 if worker < self.count % workers else 0) for worker in range(workers)]
+
+    def progress(self, workers):
+        #Samples each worker had yielded once start samples were seen, and whose turn was next.
+        #The loader takes whole batches from its workers in turn and passes over workers that have run out
+        counts = self.workerCounts(workers)
+        batches = [math.ceil(count / self.batch_size) for count in counts]
+        served = [0] * workers
+        remaining = self.start // self.batch_size
+        turn = 0
+        while remaining > 0 and served != batches:
+            if served[turn] < batches[turn]:
+                served[turn] += 1
+                remaining -= 1
+            turn = (turn + 1) % workers
+        return [min(batch * self.batch_size, count) for batch, count in zip(served, counts)], turn
+
+    def samples(self, worker, workers):
+        shards = self.shardOrder()
+        if self.num_replicas == 1 and len(shards) >= workers:
+            for path in shards[worker::workers]:
+                for sample in readShard(path):
+                    yield sample
+            return
+        #Sample p goes to rank p % num_replicas and, as that rank's k-th sample, to worker k % workers.
+        #Shards hold different numbers of samples, dealing them out would leave ranks with unequal shares
+        position = 0
+        for path in shards:
+            for sample in readShard(path):
+                if position % self.num_replicas == self.rank and (position // self.num_replicas) % workers == worker:
+                    yield sample
+                position += 1
+
+    def shuffled(self, samples, rng):
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        workers, worker = (info.num_workers, info.id) if info is not None else (1, 0)
+        #A resumed loader starts again at its first worker, so workers are renumbered to continue from the one whose turn was next
+        served, turn = self.progress(workers)
+        worker = (worker + turn) % workers
+        unit, units = self.rank * workers + worker, self.num_replicas * workers
+        rng = random.Random((self.seed + self.epoch) * units + unit)
+        #With several ranks every rank yields the same number of samples so collective steps stay matched
+        quota = None
+        if self.num_replicas > 1:
+            per_rank = len(self)
+            quota = per_rank // workers + (1 if worker < per_rank % workers else 0)
+        skip = served[worker]
+        produced = 0
+        while True:
+            stream = self.samples(worker, workers)
+            if self.shuffle:
+                stream = self.shuffled(stream, rng)
+            empty = True
+            for name, data, label in stream:
+                empty = False
+                if quota is not None and produced >= quota:
+                    return
+                produced += 1
+                if produced <= skip:
+                    continue
+                image = preprocess.openImage(io.BytesIO(data), self.draft).convert('RGB')
+                if self.transform is not None:
+                    image = self.transform(image)
+                yield image, label
+            #Short streams are padded by reading them again, like DistributedSampler
+            if quota is None or produced >= quota or empty:
+                return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir',type=str,default='flowers', help='Path to images folder with train, valid and test')
+    parser.add_argument('--out',type=str,default='shards', help='Set directory for the tar shards, default shards')
+    parser.add_argument('--shard_mb',type=int,default=256, help='Set shard size in MB, default 256')
+    parser.add_argument('--seed',type=int,default=0, help='Set seed for the order samples are packed in, default 0')
+    in_arg = parser.parse_args()
+    for split in ['train', 'valid', 'test']:
+        packShards(os.path.join(in_arg.dir, split), in_arg.out, split, in_arg.shard_mb, in_arg.seed)
@@ -1,20 +1,46 @@
 
-import numpy as np
 import torch
-from torchvision import datasets, transforms, models
+from torchvision import datasets, transforms
 from torch import nn
 from torch import optim
+import torch.nn.functional as F
 import argparse
+import contextlib
+import functools
+import json
 import os
+import sys
+import time
 import myhelper
+import backbones
+import preprocess
+import featurecache
+import instrument
+import metrics
+import imagecache
+import tarshards
+import snapshot
+import sweep
+import cluster
+from torch.nn.parallel import DistributedDataParallel
 
 
 class Train:
     
-    def __init__(self):
+    def __init__(self, args=None):
         print("Welcome to the Trainer")
         #Set input arguments
-        self.in_arg = self.get_input_args()
+        self.in_arg = self.get_input_args(args)
+        #Start one process per rank, or join the process group set up by torchrun or the launcher
+        if self.in_arg.nproc > 1 and not self.in_arg.distributed:
+            print("Launching "+str(self.in_arg.nproc)+" training processes")
+            argv = [os.path.abspath(__file__)] + (sys.argv[1:] if args is None else list(args))
+            code = cluster.launch(self.in_arg.nproc, argv)
+            if code != 0:
+                print("ERROR A training process failed")
+                sys.exit(code)
+            return
+        self.rank, self.world_size, local_rank = cluster.setup() if self.in_arg.distributed else (0, 1, 0)
         print("Will run trainer using: Path: "+str(self.in_arg.dir)+", Learning Rate: "+str(self.in_arg.learning_rate)+", Hidden Units: "+str(self.in_arg.hidden_units)+", Epochs: "+str(self.in_arg.epochs))
         #Checks
         if os.path.isdir(self.in_arg.dir) == False:
@@ -23,6 +49,9 @@ class Train:
         if self.in_arg.save_dir != "" and os.path.isdir(self.in_arg.save_dir) == False:
             print("ERROR Cannot find directory to save checkpoint at: "+self.in_arg.save_dir)
             return
+        if self.in_arg.keep < 1:
+            print("ERROR --keep must be at least 1, the newest snapshot is what --resume continues from")
+            return
         #Set directories
         self.train_dir = self.in_arg.dir + '/train'
         self.valid_dir = self.in_arg.dir + '/valid'
@@ -33,89 +62,269 @@ class Train:
         if self.device is None:
             print('You selected GPU, but GPU is not available!, closing')
             return
+        if self.device.type == 'cuda' and self.in_arg.distributed:
+            self.device = torch.device("cuda", local_rank)
         print("Using Device: "+str(self.device))
         #Set data
         self.setupData()
         #Load model
         print("Loading model "+self.in_arg.arch)
-        if self.in_arg.arch == 'vgg16':
-            self.model = models.vgg16(pretrained = True)
-        elif self.in_arg.arch == 'densenet161':
-            self.model = models.densenet161(pretrained = True)
-        for params in self.model.parameters():
-            params.requires_grad = False
+        if self.in_arg.backbone_weights is not None and os.path.isfile(self.in_arg.backbone_weights) == False:
+            print("ERROR Cannot find backbone weights at: "+self.in_arg.backbone_weights)
+            return
+        #Seeded so every rank builds the same random backbone with --no_pretrained
+        torch.manual_seed(self.in_arg.seed)
+        self.model = myhelper.backbone(self.in_arg.arch, pretrained = not self.in_arg.no_pretrained, weights = self.in_arg.backbone_weights)
+        if self.model is None:
+            print("ERROR Unknown arch "+self.in_arg.arch+", use a torchvision model such as "+", ".join(backbones.names()))
+            return
+        if self.input_size is None:
+            print("ERROR Backbone "+self.in_arg.arch+" does not give flat features to its head, use one such as "+", ".join(backbones.names()))
+            return
+        if self.in_arg.finetune and (self.in_arg.cache_features or self.in_arg.distributed or self.sweeping()):
+            print("ERROR --finetune trains the backbone from images in a single process, without --cache_features or sweeps")
+            return
         #Setup classifier
         print("Setting up classifier")
         self.classifier = myhelper.Network(self.input_size, self.output_size, self.hidden_layers, drop_p=self.drop)
         self.classifier.to(self.device)
-        self.model.classifier = self.classifier
+        myhelper.setHead(self.model, self.in_arg.arch, self.classifier)
         self.model.class_to_idx = self.image_datasets['train'].class_to_idx
         self.model.to(self.device)
-        self.optimizer = optim.Adam(self.model.classifier.parameters(), lr= self.learning_rate)
+        #Fine-tuning trains the backbone together with the classifier
+        if self.in_arg.finetune:
+            for params in self.model.parameters():
+                params.requires_grad = True
+        self.optimizer = optim.Adam(self.model.parameters() if self.in_arg.finetune else self.classifier.parameters(), lr= self.learning_rate)
         self.criterion = nn.NLLLoss()
+        self.scaler = myhelper.gradScaler(self.device, self.in_arg.precision)
+        self.metrics = metrics.Metrics(self.device)
+        #Soft targets from a trained teacher checkpoint
+        self.teacher = None
+        if self.in_arg.distill is not None and self.loadTeacher() is None:
+            return
+        #Train the classifier from cached backbone features
+        if self.in_arg.cache_features:
+            self.setupFeatures()
+        #Periodic snapshots and resuming
+        self.checkpointer = snapshot.AsyncCheckpointer(self.in_arg.save_dir, keep=self.in_arg.keep)
+        #Sweep mode trains many heads at once instead of a single classifier
+        if self.sweeping():
+            if self.in_arg.distributed or self.in_arg.resume is not None:
+                print("ERROR Sweeps run in a single process and cannot be resumed")
+                return
+            self.runSweep()
+            self.checkpointer.wait()
+            return
+        self.resumeState = self.loadResume() if self.in_arg.resume is not None else None
+        #Gradients of the classifier are averaged over all ranks
+        self.head = DistributedDataParallel(self.classifier) if self.in_arg.distributed else self.classifier
+        myhelper.setHead(self.model, self.in_arg.arch, self.head)
         #Run training, and make checkpoint
         self.runTraining(self.makeCheckpoint)
+        self.checkpointer.wait()
+        cluster.cleanup()
 
 
     def runTraining(self, completion):
-        print("Started training, will print validation every 40")
+        print("Started training, will print validation every "+str(self.in_arg.validate_every)+" steps")
         steps = 0
         running_loss = 0
-        print_every = 40
+        since_report = 0
+        start_epoch, start_batch = 0, 0
+        if self.resumeState is not None:
+            start_epoch, start_batch = self.resumeState['epoch'], self.resumeState['batch']
+            steps, running_loss = self.resumeState['steps'], self.resumeState['running_loss']
+            since_report = self.resumeState.get('since_report', steps % max(self.in_arg.validate_every, 1))
+            print("Resuming at epoch {}, batch {}, step {}".format(start_epoch+1, start_batch, steps))
+        #With cached features only the classifier needs to run
+        model = self.head if self.in_arg.cache_features else self.model
+        self.memory_format = torch.contiguous_format
+        if self.in_arg.compile != 'none':
+            print("Compiling model with "+self.in_arg.compile)
+            example = None if self.in_arg.cache_features else torch.zeros(1, 3, 224, 224)
+            model = myhelper.optimize(model, self.in_arg.compile, self.device, example, self.in_arg.compile_cache)
+            if example is not None:
+                self.memory_format = torch.channels_last
+        timer = instrument.StepTimer(self.device, detailed=self.in_arg.profile is not None)
+        tracer = instrument.traceProfiler(self.in_arg.trace) if self.in_arg.trace is not None else contextlib.nullcontext()
+        last_validation = time.perf_counter()
+        with tracer:
+            for e in range(start_epoch, self.epochs):
+                if self.in_arg.cache_features:
+                    self.loaders['train'].dataset.view = e % self.in_arg.views
+                batch = start_batch if e == start_epoch else 0
+                self.startEpoch(e, batch * self.in_arg.batch_size)
+                timer.reset()
+                for images, labels in self.loaders['train']:
+                    timer.lap('data')
+                    model.train()
+                    images, labels = images.to(self.device, non_blocking=True, memory_format=self.memory_format), labels.to(self.device, non_blocking=True)
+                    timer.detail('h2d')
+                    steps += 1
+                    self.optimizer.zero_grad()
+                    with myhelper.autocast(self.device, self.in_arg.precision):
+                        output = model.forward(images)
+                        loss = self.criterion(output, labels) if self.teacher is None else self.distillLoss(output, images, labels)
+                    timer.detail('forward')
+                    self.scaler.scale(loss).backward()
+                    timer.detail('backward')
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                    running_loss += loss.item()
+                    since_report += 1
+                    timer.lap('step' if timer.detailed else 'compute', sync=True)
+                    timer.step(len(labels))
+                    batch += 1
+                    if self.in_arg.trace is not None:
+                        tracer.step()
+                    if self.in_arg.checkpoint_every > 0 and steps % self.in_arg.checkpoint_every == 0 and cluster.isMain():
+                        self.saveResume(e, batch, steps, running_loss, since_report)
+                        timer.mark()
+
+                    if self.validationDue(steps, last_validation):
+                        test_loss, accuracy = self.validate(model, self.loaders['interim'])
+                        timer.lap('validation', sync=True)
+                        last_validation = time.perf_counter()
+                        print("Epoch: {}/{}.. ".format(e+1, self.epochs),
+                            "Training Loss: {:.3f}.. ".format(running_loss/since_report),
+                            "Validation Loss: {:.3f}.. ".format(test_loss),
+                            "Validation Accuracy: {:.3f}".format(accuracy))
+                        running_loss = 0
+                        since_report = 0
+                        model.train()
+                print("Epoch: {}/{}.. ".format(e+1, self.epochs), timer.boundReport())
+                #The full validation set is only run at the end of each epoch
+                timer.mark()
+                test_loss, accuracy = self.validate(model, self.loaders['valid'])
+                timer.lap('validation', sync=True)
+                last_validation = time.perf_counter()
+                print("Final" if e == (self.epochs - 1) else "Epoch: {}/{}.. ".format(e+1, self.epochs),
+                    "Validation Loss: {:.3f}.. ".format(test_loss),
+                    "Validation Accuracy: {:.3f}".format(accuracy))
+                if self.in_arg.checkpoint_every > 0 and e+1 < self.epochs and cluster.isMain():
+                    self.saveResume(e+1, 0, steps, running_loss, since_report)
+                if e == (self.epochs - 1):
+                    print("Training complete")
+                    #Only rank 0 writes the summary and checkpoint
+                    if cluster.isMain():
+                        if self.in_arg.profile is not None:
+                            self.writeProfile(timer)
+                        completion()
+
+    def loadTeacher(self):
+        if self.in_arg.cache_features or self.in_arg.distributed or self.sweeping():
+            print("ERROR --distill needs images in a single process, without --cache_features or sweeps")
+            return None
+        if os.path.isfile(self.in_arg.distill) == False:
+            print("ERROR Cannot find teacher checkpoint at: "+self.in_arg.distill)
+            return None
+        self.teacher, teacher = myhelper.loadCheckpoint(self.in_arg.distill, self.device)
+        if teacher['class_to_idx'] != self.model.class_to_idx:
+            print("ERROR The teacher was trained on different classes")
+            self.teacher = None
+            return None
+        self.teacher.eval()
+        self.teacher_device = teacher['device']
+        print("Distilling from "+teacher['model']+" teacher at temperature "+str(self.in_arg.temperature)+", alpha "+str(self.in_arg.alpha))
+        return self.teacher
+
+    def distillLoss(self, output, images, labels):
+        #Teacher and student log-probabilities softened by the temperature, mixed with the hard label loss
+        with torch.no_grad():
+            teacher = self.teacher.forward(images.to(self.teacher_device)).to(output.device).float()
+        T = self.in_arg.temperature
+        soft = F.kl_div(F.log_softmax(output.float() / T, dim=1), F.log_softmax(teacher / T, dim=1), reduction='batchmean', log_target=True)
+        return self.in_arg.alpha * T * T * soft + (1 - self.in_arg.alpha) * self.criterion(output, labels)
+
+    def sweeping(self):
+        return any(value is not None for value in [self.in_arg.sweep_hidden_units, self.in_arg.sweep_learning_rate, self.in_arg.sweep_drop])
+
+    def runSweep(self):
+        hidden_units = [[int(units) for units in each.split(',')] for each in self.in_arg.sweep_hidden_units or [','.join(str(units) for units in self.hidden_layers)]]
+        configs = sweep.configs(hidden_units, self.in_arg.sweep_learning_rate or [self.learning_rate], self.in_arg.sweep_drop or [self.drop])
+        print("Sweeping "+str(len(configs))+" heads on one backbone pass per batch")
+        backbone = None
+        if not self.in_arg.cache_features:
+            myhelper.setHead(self.model, self.in_arg.arch, nn.Identity())
+            self.model.eval()
+            backbone = self.model
+        self.memory_format = torch.contiguous_format
+        engine = sweep.HeadSweep(configs, self.input_size, self.output_size, self.device, self.in_arg.precision, backbone)
+        steps = 0
+        last_validation = time.perf_counter()
         for e in range(self.epochs):
+            if self.in_arg.cache_features:
+                self.loaders['train'].dataset.view = e % self.in_arg.views
+            self.startEpoch(e)
             for images, labels in self.loaders['train']:
-                self.model.train()
-                images, labels = images.to(self.device), labels.to(self.device)
+                images, labels = images.to(self.device, non_blocking=True), labels.to(self.device, non_blocking=True)
+                engine.step(images, labels, self.criterion)
                 steps += 1
-                self.optimizer.zero_grad()
-                output = self.model.forward(images)
-                loss = self.criterion(output, labels)
-                loss.backward()
-                self.optimizer.step()
-                running_loss += loss.item()
-                
-                if steps % print_every == 0:
-                    self.model.eval()
-                    with torch.no_grad():
-                        test_loss, accuracy = self.validation(self.loaders['valid'], self.model)
-                    print("Epoch: {}/{}.. ".format(e+1, self.epochs),
-                        "Training Loss: {:.3f}.. ".format(running_loss/print_every),
-                        "Validation Loss: {:.3f}.. ".format(test_loss/len(self.loaders['valid'])),
-                        "Validation Accuracy: {:.3f}".format(accuracy/len(self.loaders['valid'])))
-                    running_loss = 0
-                    self.model.train()
-            if e == (self.epochs - 1):
-                self.model.eval()
-                with torch.no_grad():
-                    test_loss, accuracy = self.validation(self.loaders['valid'], self.model)
-                print("Final",
-                    "Validation Loss: {:.3f}.. ".format(test_loss/len(self.loaders['valid'])),
-                    "Validation Accuracy: {:.3f}".format(accuracy/len(self.loaders['valid'])))
-                print("Training complete")
-                completion()
+                if self.validationDue(steps, last_validation):
+                    self.reportSweep(engine, engine.validate(self.loaders['interim'], self.criterion), "Epoch: {}/{}.. ".format(e+1, self.epochs))
+                    last_validation = time.perf_counter()
+            results = engine.validate(self.loaders['valid'], self.criterion)
+            last_validation = time.perf_counter()
+            self.reportSweep(engine, results, "Final" if e == (self.epochs - 1) else "Epoch: {}/{}.. ".format(e+1, self.epochs), full=True)
+        print("Training complete")
+        #Only the best heads are written
+        summary = []
+        for rank, index in enumerate(engine.ranking(results)):
+            config = dict(configs[index], validation_loss=results[index][0], validation_accuracy=results[index][1])
+            if rank < self.in_arg.sweep_keep:
+                config['checkpoint'] = self.in_arg.save_dir+'sweep_'+str(rank + 1)+'.pth'
+                self.makeCheckpoint(engine.heads[index], config['learning_rate'], config['drop'], config['checkpoint'])
+            summary.append(config)
+        with open(self.in_arg.save_dir+'sweep.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        print("Wrote sweep results to "+self.in_arg.save_dir+"sweep.json")
+
+    def reportSweep(self, engine, results, prefix, full=False):
+        losses = engine.trainingLoss() if not full else None
+        ranking = engine.ranking(results)
+        for rank, index in enumerate(ranking if full else ranking[:1]):
+            config = engine.configs[index]
+            line = "Hidden Units: {}.. Learning Rate: {}.. Drop: {}.. ".format(config['hidden_layers'], config['learning_rate'], config['drop'])
+            if losses is not None:
+                line += "Training Loss: {:.3f}.. ".format(losses[index])
+            print(prefix if full else prefix+"Best head.. ", line+"Validation Loss: {:.3f}.. Validation Accuracy: {:.3f}".format(*results[index]))
+
+    def writeProfile(self, timer):
+        config = {'arch': self.in_arg.arch,
+                  'device': str(self.device),
+                  'hidden_units': self.in_arg.hidden_units,
+                  'batch_size': self.in_arg.batch_size,
+                  'workers': self.in_arg.workers,
+                 'world_size': self.world_size,
+                  'prefetch': self.in_arg.prefetch,
+                  'cache_features': self.in_arg.cache_features,
+                  'image_cache': self.in_arg.image_cache,
+                  'precision': self.in_arg.precision}
+        summary = timer.writeSummary(self.in_arg.profile, config)
+        print("Throughput: {:.1f} images/sec.. ".format(summary['images_per_sec']),
+              "Per step: "+", ".join("{} {:.1f}ms".format(stage, ms) for stage, ms in summary['stage_ms_per_step'].items())+".. ",
+              "Peak memory: {:.0f} MB".format(summary['peak_memory_mb'] or 0))
 
     def setupData(self):
         mean = [0.485, 0.456, 0.406]
         sd = [0.229, 0.224, 0.225]
 
-        if self.in_arg.arch == 'vgg16' :
-            self.input_size = 25088
-        elif self.in_arg.arch == 'densenet161':
-            self.input_size = 2208
-            
-        self.output_size = 102
+        #Feature size of the backbone from a dry run, None for unknown backbones
+        self.input_size = backbones.featureSize(self.in_arg.arch)
+
         self.hidden_layers = self.in_arg.hidden_units
         self.drop = 0.5
         self.epochs = self.in_arg.epochs
         self.learning_rate = self.in_arg.learning_rate
 
         #Transforms for the training, validation, and testing sets
-        test_transforms = transforms.Compose([transforms.Resize(256),
+        self.test_transforms = test_transforms = transforms.Compose([transforms.Resize(256),
                                       transforms.CenterCrop(224),
                                       transforms.ToTensor(),
                                       transforms.Normalize(mean,sd)
                                      ])
-        train_transforms = transforms.Compose([
+        self.train_transforms = train_transforms = transforms.Compose([
                                       transforms.RandomResizedCrop(224, scale=(0.5, 1.0)),
                                       transforms.RandomHorizontalFlip(),
                                       transforms.RandomRotation(30),
@@ -123,57 +332,276 @@ class Train:
                                       transforms.Normalize(mean,sd)
                                      ])
 
-        #Load Datasets with ImageFolder
-        test_dataset = datasets.ImageFolder(self.test_dir, transform = test_transforms)
-        validation_dataset = datasets.ImageFolder(self.valid_dir, transform = test_transforms)
-        train_dataset = datasets.ImageFolder(self.train_dir, transform = train_transforms)
+        #Load Datasets with ImageFolder, or from the pre-decoded image cache
+        test_dataset = self.makeDataset('test', test_transforms)
+        validation_dataset = self.makeDataset('valid', test_transforms)
+        train_dataset = self.makeDataset('train', train_transforms)
         self.image_datasets = {'test':test_dataset, 'valid':validation_dataset, 'train':train_dataset}
+        self.output_size = len(train_dataset.classes)
 
         #Dataloaders
-        testloader = torch.utils.data.DataLoader(self.image_datasets['test'], batch_size=32,shuffle=True)
-        validloader = torch.utils.data.DataLoader(self.image_datasets['valid'], batch_size=32,shuffle=True)
-        trainloader = torch.utils.data.DataLoader(self.image_datasets['train'], batch_size=64,shuffle=True)
+        testloader = self.evalLoader(self.image_datasets['test'])
+        validloader = self.evalLoader(self.image_datasets['valid'])
+        trainloader = self.trainLoader(self.image_datasets['train'])
         self.loaders = {'test':testloader, 'valid':validloader, 'train': trainloader}
+        self.loaders['interim'] = self.interimLoader(self.image_datasets['valid'])
+
+    def makeDataset(self, split, transform):
+        if self.in_arg.tar_shards is not None:
+            with cluster.mainFirst():
+                if not tarshards.isCurrent(self.in_arg.tar_shards, split, self.in_arg.dir + '/' + split, self.in_arg.shard_mb, self.in_arg.seed):
+                    tarshards.packShards(self.in_arg.dir + '/' + split, self.in_arg.tar_shards, split, self.in_arg.shard_mb, self.in_arg.seed)
+            return tarshards.TarShardDataset(self.in_arg.tar_shards, split, transform = transform, shuffle = split == 'train',
+                                             buffer_size = self.in_arg.shuffle_buffer, seed = self.in_arg.seed, draft = self.in_arg.draft)
+        if self.in_arg.image_cache is None:
+            #Reduced JPEG decoding down to the --draft short side
+            loader = functools.partial(preprocess.loadImage, short_side = self.in_arg.draft) if self.in_arg.draft is not None else datasets.folder.default_loader
+            return datasets.ImageFolder(self.in_arg.dir + '/' + split, transform = transform, loader = loader)
+        with cluster.mainFirst():
+            if not imagecache.isCurrent(self.in_arg.image_cache, split, self.in_arg.cache_short_side, self.in_arg.dir + '/' + split):
+                imagecache.buildCache(self.in_arg.dir + '/' + split, self.in_arg.image_cache, split,
+                                      self.in_arg.cache_short_side, workers=max(self.in_arg.workers, 1))
+        return imagecache.CachedImageFolder(self.in_arg.image_cache, split, transform = transform)
+
+    def trainLoader(self, dataset):
+        if isinstance(dataset, torch.utils.data.IterableDataset):
+            return self.streamLoader(dataset, self.in_arg.batch_size)
+        #Each rank trains on its own shard of the shuffled order
+        sampler = snapshot.ResumableSampler(dataset, self.in_arg.seed, self.world_size, self.rank)
+        args = self.loaderArgs(self.in_arg.batch_size)
+        #The feature store's view is switched each epoch in this process, persistent workers would keep their old copy
+        if isinstance(dataset, featurecache.FeatureStore):
+            args.pop('persistent_workers', None)
+        return torch.utils.data.DataLoader(dataset, sampler=sampler, **args)
+
+    def evalLoader(self, dataset):
+        if isinstance(dataset, torch.utils.data.IterableDataset):
+            return self.streamLoader(dataset, self.in_arg.eval_batch_size)
+        if self.in_arg.distributed:
+            sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=False)
+            return torch.utils.data.DataLoader(dataset, sampler=sampler, **self.loaderArgs(self.in_arg.eval_batch_size))
+        return torch.utils.data.DataLoader(dataset, shuffle=True, **self.loaderArgs(self.in_arg.eval_batch_size))
+
+    def streamLoader(self, dataset, batch_size):
+        #Streamed datasets split their shards between ranks and workers themselves.
+        #Workers are restarted each epoch so they see the new epoch's shard order
+        dataset.num_replicas, dataset.rank, dataset.batch_size = self.world_size, self.rank, batch_size
+        args = self.loaderArgs(batch_size)
+        args.pop('persistent_workers', None)
+        return torch.utils.data.DataLoader(dataset, **args)
+
+    def startEpoch(self, epoch, start=0):
+        loader = self.loaders['train']
+        target = loader.dataset if isinstance(loader.dataset, torch.utils.data.IterableDataset) else loader.sampler
+        target.setEpoch(epoch, start)
+        #Worker seeds depend on the epoch only, so a resumed epoch starts its workers like the original did
+        loader.generator.manual_seed(self.in_arg.seed + epoch)
+
+    def interimLoader(self, dataset):
+        #A fixed random subset of the validation set for the checks during an epoch
+        if isinstance(dataset, torch.utils.data.IterableDataset):
+            return self.loaders['valid']
+        if self.in_arg.validate_subset <= 0 or self.in_arg.validate_subset >= len(dataset):
+            return self.loaders['valid']
+        generator = torch.Generator()
+        generator.manual_seed(self.in_arg.seed)
+        indices = sorted(torch.randperm(len(dataset), generator=generator)[:self.in_arg.validate_subset].tolist())
+        return self.evalLoader(torch.utils.data.Subset(dataset, indices))
+
+    def loaderArgs(self, batch_size):
+        #Worker processes decode and augment in parallel, pinned batches copy to the GPU asynchronously
+        #Each loader draws its worker seeds from its own generator, so creating an iterator leaves the global RNG alone
+        args = {'batch_size': batch_size,
+                'num_workers': self.in_arg.workers,
+                'pin_memory': self.in_arg.pin_memory and self.device.type == 'cuda',
+                'generator': torch.Generator()}
+        if self.in_arg.workers > 0:
+            args['prefetch_factor'] = self.in_arg.prefetch
+            args['persistent_workers'] = self.in_arg.persistent_workers
+        return args
+
+
+
+    def featureSource(self, transform):
+        #What cached features are computed from, a change to the backbone weights or preprocessing rebuilds them
+        weights = self.in_arg.backbone_weights
+        return {'pretrained': not self.in_arg.no_pretrained and weights is None,
+                'random': self.in_arg.no_pretrained and weights is None,
+                'weights': myhelper.fingerprint(weights) if weights is not None else None,
+                'transform': repr(transform),
+                'draft': self.in_arg.draft,
+                'image_cache': self.in_arg.cache_short_side if self.in_arg.image_cache is not None else None}
+
+    def setupFeatures(self):
+        if not os.path.isdir(self.in_arg.feature_dir):
+            os.makedirs(self.in_arg.feature_dir)
+        views = self.in_arg.views
+        #A single view is taken without augmentation, extra views use the random train transforms
+        train_transforms = self.train_transforms if views > 1 else self.test_transforms
+        train_dataset = self.makeDataset('train', train_transforms)
+        with cluster.mainFirst():
+            train_store = featurecache.buildFeatures(self.model, train_dataset,
+                                                     featurecache.storePrefix(self.in_arg.feature_dir, self.in_arg.arch, 'train'),
+                                                     self.in_arg.arch, views, self.in_arg.fp16_features, self.device,
+                                                     self.loaderArgs(self.in_arg.eval_batch_size), self.featureSource(train_transforms))
+            valid_store = featurecache.buildFeatures(self.model, self.image_datasets['valid'],
+                                                     featurecache.storePrefix(self.in_arg.feature_dir, self.in_arg.arch, 'valid'),
+                                                     self.in_arg.arch, 1, self.in_arg.fp16_features, self.device,
+                                                     self.loaderArgs(self.in_arg.eval_batch_size), self.featureSource(self.test_transforms))
+        self.loaders['train'] = self.trainLoader(train_store)
+        self.loaders['valid'] = self.evalLoader(valid_store)
+        self.loaders['interim'] = self.interimLoader(valid_store)
+
+    def validate(self, model, loader):
+        #Metrics stay on the device until the pass is over, then are summed over the shards of every rank
+        model.eval()
+        self.metrics.reset()
+        with torch.no_grad(), myhelper.autocast(self.device, self.in_arg.precision):
+            for images, labels in loader:
+                images = images.to(self.device, non_blocking=True, memory_format=self.memory_format)
+                labels = labels.to(self.device, non_blocking=True)
+                output = model.forward(images)
+                self.metrics.update(output, labels, self.criterion(output, labels))
+        return self.metrics.compute()
+
+    def validationDue(self, steps, last_validation):
+        due = self.in_arg.validate_every > 0 and steps % self.in_arg.validate_every == 0
+        if self.in_arg.validate_seconds > 0:
+            #Clocks differ between ranks, so the ranks agree before any of them starts a pass
+            due = cluster.anyRank(due or time.perf_counter() - last_validation >= self.in_arg.validate_seconds)
+        return due
+
+    def saveResume(self, epoch, batch, steps, running_loss, since_report):
+        #Everything needed to continue the run, the copy is taken here and written in the background
+        state = {'arch': self.in_arg.arch,
+                 'hidden_layers': self.hidden_layers,
+                 'batch_size': self.in_arg.batch_size,
+                 'seed': self.in_arg.seed,
+                 'precision': self.in_arg.precision,
+                 'epoch': epoch,
+                 'batch': batch,
+                 'steps': steps,
+                 'running_loss': running_loss,
+                 'since_report': since_report,
+                 'workers': self.in_arg.workers,
+                 'classifier': self.classifier.state_dict(),
+                 'backbone': self.backboneState() if self.storesBackbone() else None,
+                 'optimizer': self.optimizer.state_dict(),
+                 'scaler': self.scaler.state_dict(),
+                 'rng': snapshot.rngState()}
+        self.checkpointer.save(state, step=steps)
+
+    def loadResume(self):
+        path = self.checkpointer.latest() if self.in_arg.resume == 'latest' else self.in_arg.resume
+        if path is None or not os.path.isfile(path):
+            print("No snapshot to resume from, starting a new run")
+            return None
+        print("Resuming from "+path)
+        state = torch.load(path, map_location=lambda storage, loc: storage)
+        for key in ['arch', 'hidden_layers', 'batch_size', 'seed', 'precision']:
+            if state[key] != getattr(self.in_arg, key if key != 'hidden_layers' else 'hidden_units'):
+                print("ERROR Snapshot was made with "+key+" "+str(state[key])+", rerun with the same setting")
+                raise SystemExit(1)
+        #Each rank resumes within its own share of the data, which depends on the number of ranks
+        if state.get('world_size', 1) != self.world_size:
+            print("ERROR Snapshot was made with "+str(state.get('world_size', 1))+" processes, rerun with the same number")
+            raise SystemExit(1)
+        #Tar shards are split between loader workers, the position within the epoch only holds for the same number of them
+        if self.in_arg.tar_shards is not None and state.get('workers') != self.in_arg.workers:
+            print("ERROR Snapshot was made with workers "+str(state.get('workers'))+", rerun with the same setting to resume from tar shards")
+            raise SystemExit(1)
+        self.classifier.load_state_dict(state['classifier'])
+        if state.get('backbone') is not None:
+            self.model.load_state_dict(state['backbone'], strict=False)
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scaler.load_state_dict(state['scaler'])
+        snapshot.setRngState(state['rng'])
+        return state
 
+    def storesBackbone(self):
+        #Fine-tuned and random backbones cannot be rebuilt from torchvision, so their weights go in the checkpoint
+        return self.in_arg.finetune or (self.in_arg.no_pretrained and self.in_arg.backbone_weights is None)
 
+    def backboneState(self):
+        head = myhelper.headName(self.model, self.in_arg.arch) + '.'
+        return {key: value for key, value in self.model.state_dict().items() if not key.startswith(head)}
 
-    def validation(self, loader, model):
-        test_loss = 0
-        accuracy = 0
-        for images, labels in loader:
-            images, labels = images.to(self.device), labels.to(self.device)
-            output = model.forward(images)
-            test_loss += self.criterion(output, labels).item()
-            ps = torch.exp(output)
-            equality = (labels.data == ps.max(dim=1)[1])
-            accuracy += equality.type(torch.FloatTensor).mean()
-        return test_loss, accuracy
-        
-    def makeCheckpoint(self):
-        print("Making checkpoint")
+    def makeCheckpoint(self, classifier=None, learning_rate=None, drop=None, path=None):
+        classifier = self.classifier if classifier is None else classifier
+        path = self.in_arg.save_dir+'checkpoint.pth' if path is None else path
+        print("Making checkpoint "+path)
         checkpoint = {'input_size': self.input_size,
               'output_size': self.output_size,
-              'batch_size':64,
+              'batch_size': self.in_arg.batch_size,
               'epochs': self.epochs,
               #'optimizer': trainer.optimizer.state_dict,
-              'drop': self.drop,
-              'learning_rate': self.learning_rate,
+              'drop': self.drop if drop is None else drop,
+              'learning_rate': self.learning_rate if learning_rate is None else learning_rate,
               'class_to_idx': self.model.class_to_idx,
-              'hidden_layers': [each.out_features for each in self.model.classifier.hidden_layers],
+              'hidden_layers': [each.out_features for each in classifier.hidden_layers],
               'model': self.in_arg.arch,
-              'state_dict': self.model.classifier.state_dict()}
-        torch.save(checkpoint, self.in_arg.save_dir+'checkpoint.pth')
+              'pretrained': not self.in_arg.no_pretrained and self.in_arg.backbone_weights is None,
+              'precision': self.in_arg.precision,
+              'state_dict': classifier.state_dict()}
+        if self.in_arg.backbone_weights is not None:
+            checkpoint['backbone_weights'] = os.path.abspath(self.in_arg.backbone_weights)
+        if self.storesBackbone():
+            checkpoint['backbone_state_dict'] = self.backboneState()
+        #Written through the checkpointer so a crash mid-write never leaves a truncated file
+        self.checkpointer.save(checkpoint, path=path)
+        self.checkpointer.wait()
         print("All done")
 
-    def get_input_args(self):
+    def get_input_args(self, args=None):
         parser = argparse.ArgumentParser()
         parser.add_argument('--hidden_units','--list', type=int, nargs='+',default=[12544,1568], help='Set hidden units, seperated by space, default 12544,1568 for vgg16')
         parser.add_argument('--dir',type=str,default='flowers', help='Path to images folder')
         parser.add_argument('--save_dir',type=str,default='', help='Set directory to save checkpoints eg. "yourdirectory/", will save in this directory file named checkpoint.pht')
-        parser.add_argument('--arch',type=str,default='vgg16',help='Set pre trained model vgg16 or densenet161, default vgg16')
+        parser.add_argument('--arch',type=str,default='vgg16',help='Set pre trained model, any registered backbone (vgg16, densenet161, resnet18, resnet50, mobilenet_v2, mobilenet_v3_large, efficientnet_b0) or other torchvision model, default vgg16')
+        parser.add_argument('--backbone_weights',type=str,help='Set a locally saved torchvision state_dict to start the backbone from instead of downloading')
+        parser.add_argument('--finetune',action='store_true',help='Train the backbone together with the classifier, its weights are saved in the checkpoint')
+        parser.add_argument('--distill',type=str,help='Set a trained checkpoint to use as teacher, the student is --arch')
+        parser.add_argument('--temperature',type=float,default=4.0,help='Set distillation temperature, default 4')
+        parser.add_argument('--alpha',type=float,default=0.7,help='Set weight of the teacher loss against the label loss when distilling, default 0.7')
         parser.add_argument('--learning_rate',type=float,default='0.001',help='Set learning rate, default 0.001')
         parser.add_argument('--epochs',type=int,default='5',help='Set epochs, default 5')
         parser.add_argument('--gpu',type=str, default="no", help='Set yes to use GPU, default CPU')
-        return parser.parse_args() 
+        parser.add_argument('--no_pretrained',action='store_true',help='Start the backbone from random weights instead of downloading pretrained ones')
+        parser.add_argument('--batch_size',type=int,default=64,help='Set training batch size, default 64')
+        parser.add_argument('--eval_batch_size',type=int,default=32,help='Set validation and test batch size, default 32')
+        parser.add_argument('--workers',type=int,default=0,help='Set number of data loading worker processes, default 0 (load in the training process)')
+        parser.add_argument('--prefetch',type=int,default=2,help='Set batches prefetched per worker, default 2')
+        parser.add_argument('--persistent_workers',action='store_true',help='Keep data loading workers alive between epochs')
+        parser.add_argument('--pin_memory',action='store_true',help='Use pinned host memory for faster copies to the GPU')
+        parser.add_argument('--checkpoint_every',type=int,default=0,help='Snapshot model, optimizer and data position every N steps and at each epoch end, default 0 (off)')
+        parser.add_argument('--keep',type=int,default=3,help='Set number of snapshots to keep, at least 1, default 3')
+        parser.add_argument('--resume',type=str,help='Continue from a snapshot path, or "latest" for the newest one in --save_dir')
+        parser.add_argument('--seed',type=int,default=0,help='Set seed for the training data order and random backbone weights, default 0')
+        parser.add_argument('--precision',type=str,default='fp32',choices=['fp32','bf16','fp16'],help='Set autocast precision for forward passes, fp16 adds loss scaling, default fp32')
+        parser.add_argument('--nproc',type=int,default=1,help='Launch this many data-parallel training processes on this host, each using --batch_size, default 1')
+        parser.add_argument('--distributed',action='store_true',help='Join a gloo process group from torchrun style environment variables (set by --nproc or torchrun)')
+        parser.add_argument('--validate_every',type=int,default=40,help='Set training steps between validation checks during an epoch, 0 for none, default 40')
+        parser.add_argument('--validate_seconds',type=float,default=0,help='Also validate once this many seconds have passed since the last check, default 0 (off)')
+        parser.add_argument('--validate_subset',type=int,default=0,help='Check on a fixed random subset of this many validation images during an epoch, the full set is used at epoch end, default 0 (full set)')
+        parser.add_argument('--sweep_hidden_units',type=str,nargs='+',help='Sweep these hidden layer configurations, each comma separated, eg. 1024,256 512')
+        parser.add_argument('--sweep_learning_rate',type=float,nargs='+',help='Sweep these learning rates')
+        parser.add_argument('--sweep_drop',type=float,nargs='+',help='Sweep these dropout probabilities')
+        parser.add_argument('--sweep_keep',type=int,default=1,help='Set number of best sweep heads to write checkpoints for, default 1')
+        parser.add_argument('--compile',type=str,default='none',choices=['none','inductor'],help='Set graph compilation of the training model, inductor uses torch.compile with channels_last inputs, default none')
+        parser.add_argument('--compile_cache',type=str,default='.compile_cache',help='Set directory for compiled kernels reused across runs, default .compile_cache')
+        parser.add_argument('--profile',type=str,help='Time every training stage (adds a sync per stage) and write a JSON run summary to this path')
+        parser.add_argument('--trace',type=str,help='Export a torch.profiler Chrome trace of a few training steps to this path')
+        parser.add_argument('--draft',type=int,help='Decode JPEGs at a reduced scale keeping the short side at least this many pixels, eg. 256')
+        parser.add_argument('--image_cache',type=str,help='Set directory of a pre-decoded image cache, built on first use')
+        parser.add_argument('--cache_short_side',type=int,default=256,help='Set short side of images in the image cache, default 256')
+        parser.add_argument('--tar_shards',type=str,help='Set directory of tar shards streamed sequentially, packed from --dir on first use')
+        parser.add_argument('--shard_mb',type=int,default=256,help='Set size of newly packed tar shards in MB, default 256')
+        parser.add_argument('--shuffle_buffer',type=int,default=1000,help='Set samples held in the tar shard shuffle buffer, default 1000')
+        parser.add_argument('--cache_features',action='store_true',help='Run the frozen backbone once and train the classifier from cached features')
+        parser.add_argument('--feature_dir',type=str,default='features',help='Set directory for cached features, default features')
+        parser.add_argument('--views',type=int,default=1,help='Set number of augmented views to cache per training image, default 1 (no augmentation)')
+        parser.add_argument('--fp16_features',action='store_true',help='Store cached features as float16 to halve their size')
+        return parser.parse_args(args)
 
-Train()
\ No newline at end of file
+if __name__ == '__main__':
+    Train()
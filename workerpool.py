@@ -0,0 +1,92 @@
+import gc
+import multiprocessing
+import os
+import queue
+import torch
+
+
+def serve(function, threads, tasks, results):
+    #Worker loop, intra-op threads are limited so the workers together do not oversubscribe the cores
+    torch.set_num_threads(threads)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        index, args = task
+        try:
+            results.put((index, function(*args), None))
+        except Exception as error:
+            results.put((index, None, repr(error)))
+
+
+class WorkerPool:
+    #Forked worker processes running function on tasks handed out over a queue.
+    #Everything loaded before the pool starts, such as the model, is shared copy-on-write instead of loaded per worker
+    def __init__(self, function, workers, threads=None):
+        context = multiprocessing.get_context('fork')
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        #Tasks handed out whose results have not been read yet
+        self.outstanding = 0
+        #Objects that exist now are left out of garbage collection, so collections in the workers do not write to their pages
+        gc.collect()
+        gc.freeze()
+        self.processes = [context.Process(target=serve, args=(function, self.threads, self.tasks, self.results), daemon=True)
+                          for i in range(workers)]
+        for process in self.processes:
+            process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def result(self):
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                if any(not process.is_alive() for process in self.processes):
+                    raise RuntimeError("A worker process exited unexpectedly")
+
+    def map(self, tasks, prefetch=2):
+        #Yields function(*task) for each task in input order, keeping at most prefetch tasks per worker in flight
+        iterator = iter(tasks)
+        done = {}
+        submitted, index = 0, 0
+        while True:
+            while submitted - index < prefetch * len(self.processes):
+                task = next(iterator, None)
+                if task is None:
+                    break
+                self.tasks.put((submitted, task))
+                self.outstanding += 1
+                submitted += 1
+            if index == submitted:
+                return
+            while index not in done:
+                position, value, error = self.result()
+                self.outstanding -= 1
+                if error is not None:
+                    raise RuntimeError("Worker failed: "+error)
+                done[position] = value
+            yield done.pop(index)
+            index += 1
+
+    def close(self):
+        #After an error or an early exit, unread results can block a worker from exiting, so the workers are stopped instead
+        if self.outstanding > 0:
+            for process in self.processes:
+                process.terminate()
+            self.tasks.cancel_join_thread()
+        else:
+            for process in self.processes:
+                if process.is_alive():
+                    self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.tasks.close()
+        self.results.close()
+        gc.unfreeze()